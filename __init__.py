@@ -4,10 +4,11 @@ Read the README.
 """
 import os
 from os.path import abspath, dirname
+import pipes
 import sys
+import threading
 from datetime import datetime
-import zipfile
-import zlib
+import json
 from fabric.api import env, put, local, settings, hide
 from fabric.context_managers import lcd
 from fabric.decorators import task
@@ -61,34 +62,47 @@ def _setup_env():
     env.activate_path = join(env.ve_path, 'bin', 'activate')
 
 
+def _s3cmd_path():
+    """
+    Absolute path of the bundled s3cmd.  Transfers run in threads, so
+    they can't use lcd(): env.lcwd is shared by all of them.
+    """
+    return join(env.sites_path, 'fablib', 'bin', 's3cmd')
+
+
 def _s3cmd_put(src_path, bucket):
     """Copy local directory to S3 bucket"""
     if not os.path.exists(env.s3cmd_cfg):
         abort("Could not find 's3cmd.cfg' repository at '%(s3cmd_cfg)s'." % env)
 
-    with lcd(env.sites_path):
-        local('fablib/bin/s3cmd --config=%s put' \
-                ' --rexclude ".*/\.[^/]*$"' \
-                ' --acl-public' \
-                ' --add-header="Cache-Control:max-age=300"' \
-                ' -r %s/ s3://%s/' \
-                % (env.s3cmd_cfg, src_path, bucket))
+    return local('%s --config=%s put' \
+            ' --rexclude ".*/\.[^/]*$"' \
+            ' --acl-public' \
+            ' --add-header="Cache-Control:max-age=300"' \
+            ' -r %s/ s3://%s/' \
+            % (_s3cmd_path(), env.s3cmd_cfg, src_path, bucket))
 
 
-def _s3cmd_sync(src_path, bucket):
-    """Sync local directory with S3 bucket"""
+def _s3cmd_sync(src_path, bucket, *more_buckets):
+    """
+    Sync local directory with S3 bucket.  s3cmd syncs to any additional
+    buckets in parallel, reusing the same local file list.
+    """
 
     if not os.path.exists(env.s3cmd_cfg):
         abort("Could not find 's3cmd.cfg' repository at '%(s3cmd_cfg)s'." % env)
 
-    with lcd(env.sites_path):
-        local('fablib/bin/s3cmd --config=%s sync' \
-                ' --rexclude ".*/\.[^/]*$"' \
-                ' --delete-removed --acl-public' \
-                ' --add-header="Cache-Control:max-age=300"' \
-                ' --no-preserve' \
-                ' %s/ s3://%s/' \
-                % (env.s3cmd_cfg, src_path, bucket))
+    add_destinations = ''.join([' --add-destination=s3://%s/' % b
+        for b in more_buckets])
+
+    return local('%s --config=%s sync' \
+            ' --rexclude ".*/\.[^/]*$"' \
+            ' --delete-removed --acl-public' \
+            ' --add-header="Cache-Control:max-age=300"' \
+            ' --no-preserve --defer-md5' \
+            '%s' \
+            ' %s/ s3://%s/' \
+            % (_s3cmd_path(), env.s3cmd_cfg, add_destinations, src_path, bucket))
 
 
 
@@ -103,6 +117,7 @@ if _config:
 
 
     def _make_zip(file_path):
+        import zipfile
         notice('Creating zip file: %s' % file_path)
         with zipfile.ZipFile(file_path, 'w', zipfile.ZIP_DEFLATED) as f_zip:
             for r in _config['stage']:
@@ -167,9 +182,9 @@ if _config:
                     warn('continuing anyway')
                 elif not msg.startswith('[master'):
                     abort("Unexpected result: %s" % msg)
-            local('git push')
 
-            git.push_tag(_config['version'])
+            # Push commit and tag together
+            git.push_tag(_config['version'], push_branch=True)
 
         # Copy to local CDN repository
         cdn_path = join(env.cdn_path, _config['version'])
@@ -280,30 +295,32 @@ if _config and 'deploy' in _config:
                 % (env.s3cmd_cfg, bucket))
 
 
-    @task
-    def render(env_type):
-        """Render templates (deploy except for actual sync with S3)"""
-        _setup_env()
-
-        # Activate local virtual environment (for render_templates+flask?)
-        local('. %s' % env.activate_path)
-
-        if not os.path.exists(env.s3cmd_cfg):
-            abort("Could not find 's3cmd.cfg' repository at '%(s3cmd_cfg)s'.")
-
+    def _check_env_type(env_type):
+        """Make sure env_type is a valid deployment in config file"""
         if not env_type in _config['deploy']:
             abort('Could not find "%s" in "deploy" in config file' % env_type)
 
         if not "bucket" in _config['deploy'][env_type]:
             abort('Could not find "bucket" in deploy.%s" in config file' % env_type)
 
+
+    def _render_key(env_type):
+        """Settings which determine the rendered output for env_type"""
+        deploy_config = _config['deploy'][env_type]
+        return json.dumps([
+            deploy_config.get('deploy_context', {}),
+            deploy_config.get('usemin_context'),
+            deploy_config.get('copy')], sort_keys=True)
+
+
+    def _render(env_type, deploy_path):
+        """Render templates for env_type into deploy_path"""
         if 'usemin_context' in _config['deploy'][env_type]:
             usemin_context = _config['deploy'][env_type]['usemin_context']
         else:
             usemin_context = None
 
         template_path = join(_config['project_path'], 'website', 'templates')
-        deploy_path = join(_config['project_path'], 'build', 'website')
 
         clean(deploy_path)
 
@@ -315,7 +332,8 @@ if _config and 'deploy' in _config:
 
         # Sometimes we need this path append to import app from website
         # in render_templates, dunno why:
-        sys.path.append(_config['project_path'])
+        if not _config['project_path'] in sys.path:
+            sys.path.append(_config['project_path'])
 
         static.render_templates(template_path, deploy_path, deploy_context)
         static.usemin(_config, [deploy_path], usemin_context)
@@ -328,33 +346,123 @@ if _config and 'deploy' in _config:
 
         # Additional copy?
         if 'copy' in _config['deploy'][env_type]:
-            static.copy(_config, _config['deploy'][env_type]['copy'])
+            static.copy(_config, _rebase_copy(
+                _config['deploy'][env_type]['copy'], deploy_path))
+
+
+    def _rebase_copy(copy_param, deploy_path):
+        """
+        Point "copy" entries for env_type at deploy_path.  Destinations
+        are written for build/website, which other deploy paths replace.
+        """
+        website_path = join(_config['build_path'], 'website')
+        if deploy_path == website_path:
+            return copy_param
+
+        rebased = []
+        for r in copy_param:
+            dst = os.path.normpath(join(_config['project_path'], r['dst']))
+            if dst != website_path and \
+                    not dst.startswith(website_path + os.sep):
+                abort('Cannot render to %s: "copy" destination %s is' \
+                    ' outside %s' % (deploy_path, r['dst'], website_path))
+            r = dict(r)
+            r['dst'] = deploy_path + dst[len(website_path):]
+            rebased.append(r)
+        return rebased
+
+
+    def _render_all(env_types):
+        """
+        Render templates once for each distinct deployment among env_types.
+        Returns a list of (deploy_path, [env_type, ...]) tuples.
+        """
+        _setup_env()
+
+        if not env_types:
+            abort('Specify at least one deployment, e.g. stg|prd')
+
+        # Activate local virtual environment (for render_templates+flask?)
+        local('. %s' % env.activate_path)
+
+        if not os.path.exists(env.s3cmd_cfg):
+            abort("Could not find 's3cmd.cfg' repository at '%(s3cmd_cfg)s'.")
+
+        # Group env_types which render identically, in order of appearance
+        groups = []
+        group_by_key = {}
+        for env_type in env_types:
+            _check_env_type(env_type)
+            key = _render_key(env_type)
+            if not key in group_by_key:
+                group_by_key[key] = []
+                groups.append(group_by_key[key])
+            group_by_key[key].append(env_type)
+
+        build_path = _config['build_path']
+        rendered = []
+        for i, group_env_types in enumerate(groups):
+            if i == 0:
+                deploy_path = join(build_path, 'website')
+            else:
+                deploy_path = join(build_path, 'website-%s' % group_env_types[0])
+            notice('rendering %s' % ', '.join(group_env_types))
+            _render(group_env_types[0], deploy_path)
+            rendered.append((deploy_path, group_env_types))
+        return rendered
+
+
+    def _run_parallel(calls):
+        """Run (func, args) calls concurrently, abort if any of them fail"""
+        results = [None] * len(calls)
+
+        def _run(i, func, args):
+            results[i] = func(*args)
+
+        with settings(warn_only=True):
+            threads = [threading.Thread(target=_run, args=(i, func, args))
+                for i, (func, args) in enumerate(calls)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+        if [r for r in results if r is None or r.failed]:
+            abort('One or more transfers to S3 failed')
 
 
     @task
-    def put(env_type):
-        """Put (copy) website to S3 bucket.  Specify stg|prd as argument."""
-        render(env_type)
+    def render(env_type):
+        """Render templates (deploy except for actual sync with S3)"""
+        _render_all([env_type])
 
-        bucket = _config['deploy'][env_type]['bucket']
-        notice('copying to %s' % bucket)
+
+    @task
+    def put(*env_types):
+        """Put (copy) website to S3 bucket(s).  Specify stg|prd as argument(s)."""
+        calls = []
+        for deploy_path, group_env_types in _render_all(env_types):
+            for env_type in group_env_types:
+                bucket = _config['deploy'][env_type]['bucket']
+                notice('copying to %s' % bucket)
+                calls.append((_s3cmd_put, (deploy_path, bucket)))
 
         # Copy to S3
-        deploy_path = join(_config['project_path'], 'build', 'website')
-        _s3cmd_put(deploy_path, bucket)
+        _run_parallel(calls)
 
 
     @task
-    def deploy(env_type):
-        """Deploy website to S3 bucket.  Specify stg|prd as argument."""
-        render(env_type)
-
-        bucket = _config['deploy'][env_type]['bucket']
-        notice('deploying to %s' % bucket)
+    def deploy(*env_types):
+        """Deploy website to S3 bucket(s).  Specify stg|prd as argument(s)."""
+        calls = []
+        for deploy_path, group_env_types in _render_all(env_types):
+            buckets = [_config['deploy'][env_type]['bucket']
+                for env_type in group_env_types]
+            notice('deploying to %s' % ', '.join(buckets))
+            calls.append((_s3cmd_sync, [deploy_path] + buckets))
 
         # Sync to S3
-        deploy_path = join(_config['project_path'], 'build', 'website')
-        _s3cmd_sync(deploy_path, bucket)
+        _run_parallel(calls)
 
 
 @task
@@ -382,6 +490,15 @@ def serve(ssl='n', port='5000'):
                 local('python api.py'+opts)
 
 
+@task
+def fablib_profile_import(limit='25'):
+    """Show which imports slow down loading the fabfile"""
+    _setup_env()
+    profiler_path = join(dirname(abspath(__file__)), 'importprofile.py')
+    local(' '.join(map(pipes.quote, [sys.executable, profiler_path,
+        join(env.project_path, 'fabfile.py'), limit])))
+
+
 @task
 def dump():
     """Dump env and config (if applicable) to stdout"""
@@ -1,7 +1,6 @@
 """
 Amazon Web Services
 """
-import boto
 from .utils import abort
 
 
@@ -22,6 +21,9 @@ def get_s3_con():
     global _s3_con
     
     if _s3_con is None:
+        # boto is slow to import, so only load it when it's needed
+        import boto
+        import boto.exception
         try:
             _s3_con = boto.connect_s3()
         except boto.exception.NoAuthHandlerFound:
@@ -0,0 +1,439 @@
+## Amazon S3 manager - many small requests at once from one thread
+## License: GPL Version 2
+
+import errno
+import heapq
+import os
+import select
+import socket
+import time
+from logging import debug, info, warning, error
+
+try:
+    import ssl
+except ImportError:
+    ssl = None
+
+from Utils import getTextFromXml
+from Exceptions import ParameterError, S3Error, S3RequestError
+
+__all__ = [ "AsyncTransport" ]
+
+class IncompleteResponse(socket.error):
+    pass
+
+class _Exchange(object):
+    """One request, until it succeeds or runs out of retries"""
+    def __init__(self, key, request, body, retries):
+        self.key = key
+        self.request = request
+        self.body = body or ""
+        self.retries = retries
+        self.started = time.time()
+
+class _Connection(object):
+    """
+    Non-blocking HTTP/1.1 connection, kept alive for further requests.
+    step() is called whenever the socket is ready for what 'want' says
+    ("r" or "w") and moves the current request along, through the
+    states connect -> [handshake] -> send -> recv -> idle.
+    """
+    def __init__(self, id, address, ssl_hostname):
+        self.id = id
+        self.counter = 0
+        self.ssl_hostname = ssl_hostname
+        family, socktype, proto, canonname, sockaddr = address
+        self.sock = socket.socket(family, socktype, proto)
+        self.sock.setblocking(0)
+        err = self.sock.connect_ex(sockaddr)
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            self.sock.close()
+            raise socket.error(err, os.strerror(err))
+        self.state = "connect"
+        self.want = "w"
+        self.exchange = None
+        self.keep_alive = False
+        self.last_active = time.time()
+
+    def start(self, exchange, data):
+        self.exchange = exchange
+        self.out = memoryview(data)
+        self.inbuf = ""
+        self.response = None
+        self.counter += 1
+        if self.state == "idle":
+            self.state = "send"
+        self.want = "w"
+        self.last_active = time.time()
+
+    def is_alive(self):
+        """False if the server has closed this idle connection, see ConnMan"""
+        try:
+            return not select.select([self.sock], [], [], 0)[0]
+        except (select.error, socket.error, ValueError):
+            return False
+
+    def close(self):
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+
+    def _call(self, func, *args):
+        ## Returns (done, result) - not done if the socket isn't ready yet
+        try:
+            return True, func(*args)
+        except socket.error, e:
+            if ssl and isinstance(e, ssl.SSLError):
+                if e.args[0] == ssl.SSL_ERROR_WANT_READ:
+                    self.want = "r"
+                    return False, None
+                if e.args[0] == ssl.SSL_ERROR_WANT_WRITE:
+                    self.want = "w"
+                    return False, None
+            elif e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return False, None
+            raise
+
+    def step(self):
+        """Returns the response once it is complete, None until then"""
+        self.last_active = time.time()
+        if self.state == "connect":
+            err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                raise socket.error(err, os.strerror(err))
+            if self.ssl_hostname:
+                self.sock = _wrap_ssl(self.sock, self.ssl_hostname)
+                self.state = "handshake"
+            else:
+                self.state = "send"
+        if self.state == "handshake":
+            done, result = self._call(self.sock.do_handshake)
+            if not done:
+                return None
+            self.state = "send"
+            self.want = "w"
+        if self.state == "send":
+            done, sent = self._call(self.sock.send, self.out)
+            if not done:
+                return None
+            self.out = self.out[sent:]
+            if len(self.out):
+                self.want = "w"
+                return None
+            self.state = "recv"
+            self.want = "r"
+            return None
+        if self.state == "recv":
+            eof = False
+            while True:
+                done, data = self._call(self.sock.recv, 65536)
+                if not done:
+                    break
+                if not data:
+                    eof = True
+                    break
+                self.inbuf += data
+                ## SSL may hold decrypted data select() doesn't know about
+                if not (self.ssl_hostname and self.sock.pending()):
+                    break
+            return self._parse(eof)
+        return None
+
+    def _parse(self, eof):
+        if self.response is None:
+            end = self.inbuf.find("\r\n\r\n")
+            if end < 0:
+                if eof:
+                    raise IncompleteResponse("Connection closed before the response")
+                return None
+            lines = self.inbuf[:end].split("\r\n")
+            self.inbuf = self.inbuf[end + 4:]
+            version, status, reason = (lines[0].split(" ", 2) + [""])[:3]
+            headers = {}
+            for line in lines[1:]:
+                name, value = line.split(":", 1)
+                name, value = name.strip().lower(), value.strip()
+                ## Repeated headers are joined, as httplib does
+                headers[name] = headers.has_key(name) and "%s, %s" % (headers[name], value) or value
+            status = int(status)
+            if status < 200:
+                ## 100 Continue and the like - the response follows
+                return self._parse(eof)
+            self.response = { "status" : status, "reason" : reason, "headers" : headers }
+            self.keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+
+        headers = self.response["headers"]
+        data = None
+        if self.exchange.request.method_string == "HEAD" or self.response["status"] in (204, 304):
+            data = ""
+        elif headers.get("transfer-encoding", "").lower() == "chunked":
+            data = self._dechunk()
+        elif headers.has_key("content-length"):
+            length = int(headers["content-length"])
+            if len(self.inbuf) >= length:
+                data = self.inbuf[:length]
+        else:
+            ## Ends when the server closes the connection
+            self.keep_alive = False
+            if eof:
+                data = self.inbuf
+        if data is None:
+            if eof:
+                raise IncompleteResponse("Connection closed before the end of the response")
+            return None
+
+        if eof:
+            self.keep_alive = False
+        response = self.response
+        response["data"] = data
+        self.response = None
+        self.state = "idle"
+        return response
+
+    def _dechunk(self):
+        ## Body of a chunked response, None until all of it is there
+        chunks = []
+        pos = 0
+        while True:
+            end = self.inbuf.find("\r\n", pos)
+            if end < 0:
+                return None
+            size = int(self.inbuf[pos:end].split(";")[0], 16)
+            pos = end + 2
+            if size == 0:
+                ## Skip trailers up to the empty line
+                end = self.inbuf.find("\r\n", pos)
+                while end > pos:
+                    pos = end + 2
+                    end = self.inbuf.find("\r\n", pos)
+                if end < 0:
+                    return None
+                return "".join(chunks)
+            if len(self.inbuf) < pos + size + 2:
+                return None
+            chunks.append(self.inbuf[pos:pos + size])
+            pos += size + 2
+
+def _wrap_ssl(sock, hostname):
+    if hasattr(ssl, "create_default_context"):
+        ## Python 2.7.9+, verifies certificates like httplib does
+        context = ssl.create_default_context()
+        return context.wrap_socket(sock, server_hostname = hostname, do_handshake_on_connect = False)
+    return ssl.wrap_socket(sock, do_handshake_on_connect = False)
+
+def _split_host(hostname, default_port):
+    if hostname.startswith("[") or hostname.count(":") != 1:
+        return hostname.strip("[]"), default_port
+    host, port = hostname.split(":")
+    return host, int(port)
+
+class AsyncTransport(object):
+    """
+    Sends S3 requests from a single thread, many at once, over
+    non-blocking sockets. Requests are signed S3Request objects and
+    responses are dicts like those of S3.send_request(), with the same
+    retries. Meant for many small requests, where most of the time is
+    spent waiting for S3 to answer.
+    """
+    def __init__(self, s3, concurrency):
+        self.s3 = s3
+        self.config = s3.config
+        self.concurrency = max(1, concurrency)
+        self.idle = {}          ## {conn_id: [idle _Connections]}
+        self.addresses = {}     ## {(host, port): getaddrinfo() result}
+
+    def run(self, jobs):
+        """
+        run(jobs) -> iterator
+
+        Send the requests of (key, request, body) jobs and yield
+        (key, response, error) as they finish, error being None or the
+        S3Error or S3RequestError the request failed with. Jobs are only
+        taken from the iterable as there is room for them.
+        """
+        jobs = iter(jobs)
+        exhausted = False
+        ready = []          ## exchanges to start
+        delayed = []        ## heap of (time, seq, exchange) to retry later
+        busy = []           ## _Connections with a request in flight
+        try:
+            while True:
+                while not exhausted and len(ready) + len(delayed) + len(busy) < self.concurrency:
+                    try:
+                        key, request, body = jobs.next()
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    ready.append(_Exchange(key, request, body, self.s3._max_retries))
+
+                now = time.time()
+                while delayed and delayed[0][0] <= now:
+                    ready.append(heapq.heappop(delayed)[2])
+
+                results = []
+                while ready:
+                    exchange = ready.pop(0)
+                    try:
+                        busy.append(self._start(exchange))
+                    except ParameterError:
+                        raise
+                    except (socket.error, ValueError), e:
+                        results.append(self._failed(exchange, e, False, ready, delayed))
+
+                if busy:
+                    timeout = delayed and min(1, max(0, delayed[0][0] - now)) or 1
+                    for conn in self._wait(busy, timeout):
+                        exchange = conn.exchange
+                        try:
+                            response = conn.step()
+                        except (socket.error, ValueError), e:
+                            busy.remove(conn)
+                            conn.close()
+                            results.append(self._failed(exchange, e, conn.counter > 1, ready, delayed))
+                            continue
+                        if response is None:
+                            continue
+                        busy.remove(conn)
+                        conn.exchange = None
+                        if conn.keep_alive:
+                            self.idle.setdefault(conn.id, []).append(conn)
+                        else:
+                            conn.close()
+                        results.append(self._finished(exchange, response, ready, delayed))
+
+                    now = time.time()
+                    for conn in busy[:]:
+                        if now - conn.last_active > self.config.socket_timeout:
+                            busy.remove(conn)
+                            conn.close()
+                            results.append(self._failed(conn.exchange, socket.timeout("timed out"), False, ready, delayed))
+                elif delayed and not ready:
+                    time.sleep(max(0, delayed[0][0] - time.time()))
+                elif exhausted and not ready:
+                    break
+
+                for result in results:
+                    if result:
+                        yield result
+        finally:
+            for conn in busy:
+                conn.close()
+            for pool in self.idle.values():
+                for conn in pool:
+                    conn.close()
+            self.idle = {}
+
+    def _start(self, exchange):
+        method_string, resource, headers = exchange.request.get_triplet()
+        if not headers.has_key('content-length'):
+            headers['content-length'] = len(exchange.body)
+        hostname = self.s3.get_hostname(resource['bucket'])
+        uri = self.s3.format_uri(resource)
+        debug("AsyncTransport: %s %s (%i bytes)" % (method_string, uri, len(exchange.body)))
+        lines = [ "%s %s HTTP/1.1" % (method_string, uri), "Host: %s" % hostname, "Accept-Encoding: identity" ]
+        for header in headers.keys():
+            lines.append("%s: %s" % (header, headers[header]))
+        data = "\r\n".join(lines) + "\r\n\r\n" + exchange.body
+        conn = self._connection(hostname)
+        conn.start(exchange, data)
+        return conn
+
+    def _connection(self, hostname):
+        ## An idle connection to hostname if there is one, else a new one
+        cfg = self.config
+        if cfg.proxy_host != "":
+            if cfg.use_https:
+                raise ParameterError("use_ssl=True can't be used with proxy")
+            conn_id = "proxy://%s:%s" % (cfg.proxy_host, cfg.proxy_port)
+            host, port = cfg.proxy_host, int(cfg.proxy_port)
+        else:
+            conn_id = "http%s://%s" % (cfg.use_https and "s" or "", hostname)
+            host, port = _split_host(hostname, cfg.use_https and 443 or 80)
+        pool = self.idle.get(conn_id)
+        while pool:
+            conn = pool.pop()
+            if conn.is_alive():
+                return conn
+            debug("AsyncTransport: dropping connection closed by server: %s#%d" % (conn.id, conn.counter))
+            conn.close()
+        if not self.addresses.has_key((host, port)):
+            self.addresses[(host, port)] = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)[0]
+        debug("AsyncTransport: creating new connection: %s" % conn_id)
+        return _Connection(conn_id, self.addresses[(host, port)], cfg.use_https and cfg.proxy_host == "" and host or None)
+
+    def _wait(self, busy, timeout):
+        ## Connections ready for what they want to do next
+        if hasattr(select, "poll"):
+            poller = select.poll()
+            by_fd = {}
+            for conn in busy:
+                by_fd[conn.sock.fileno()] = conn
+                poller.register(conn.sock, conn.want == "r" and select.POLLIN or select.POLLOUT)
+            try:
+                events = poller.poll(timeout * 1000)
+            except select.error, e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                return []
+            return [by_fd[fd] for fd, event in events]
+
+        ## No poll() on Windows
+        readers = [conn.sock for conn in busy if conn.want == "r"]
+        writers = [conn.sock for conn in busy if conn.want == "w"]
+        try:
+            readable, writable, broken = select.select(readers, writers, [], timeout)
+        except select.error, e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return []
+        ready = set(readable + writable)
+        return [conn for conn in busy if conn.sock in ready]
+
+    def _retry(self, exchange, delay, ready, delayed):
+        if delay:
+            heapq.heappush(delayed, (time.time() + delay, id(exchange), exchange))
+        else:
+            ready.append(exchange)
+
+    def _failed(self, exchange, e, reused, ready, delayed):
+        ## Connection error - retry, or return the failure
+        resource_uri = exchange.request.resource['uri']
+        if reused:
+            debug("Request failed on a reused connection, reconnecting: %s (%s)" % (resource_uri, e))
+            self._retry(exchange, 0, ready, delayed)
+            return None
+        if exchange.retries:
+            warning("Retrying failed request: %s (%s)" % (resource_uri, e))
+            warning("Waiting %d sec..." % self.s3._fail_wait(exchange.retries))
+            self._retry(exchange, self.s3._fail_wait(exchange.retries), ready, delayed)
+            exchange.retries -= 1
+            return None
+        return exchange.key, None, S3RequestError("Request failed for: %s" % resource_uri)
+
+    def _finished(self, exchange, response, ready, delayed):
+        ## Complete response - retry like S3.send_request(), or return it
+        debug("Response: %s" % response)
+        response["elapsed"] = time.time() - exchange.started
+        if response["status"] == 307:
+            ## RedirectPermanent
+            redir_bucket = getTextFromXml(response['data'], ".//Bucket")
+            redir_hostname = getTextFromXml(response['data'], ".//Endpoint")
+            self.s3.set_hostname(redir_bucket, redir_hostname)
+            warning("Redirected to: %s" % (redir_hostname))
+            self._retry(exchange, 0, ready, delayed)
+            return None
+
+        if response["status"] >= 500 and exchange.retries:
+            warning(u"Retrying failed request: %s" % exchange.request.resource['uri'])
+            warning(unicode(S3Error(response)))
+            warning("Waiting %d sec..." % self.s3._fail_wait(exchange.retries))
+            self._retry(exchange, self.s3._fail_wait(exchange.retries), ready, delayed)
+            exchange.retries -= 1
+            return None
+
+        if response["status"] < 200 or response["status"] > 299:
+            return exchange.key, response, S3Error(response)
+        return exchange.key, response, None
+
+# vim:et:ts=4:sts=4:ai
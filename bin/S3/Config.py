@@ -74,6 +74,7 @@ class Config(object):
     mime_type = ""
     enable_multipart = True
     multipart_chunk_size_mb = 15    # MB
+    multipart_adaptive_chunks = True
     # List of checks to be performed for 'sync'
     sync_checks = ['size', 'md5']   # 'weak-timestamp'
     # List of compiled REGEXPs
@@ -97,6 +98,15 @@ class Config(object):
     website_endpoint = "http://%(bucket)s.s3-website-%(location)s.amazonaws.com/"
     additional_destinations = []
     cache_file = ""
+    hash_workers = 4
+    defer_md5 = False
+    list_workers = 1
+    list_shards = ""
+    parallel = 1
+    part_workers = 1
+    max_connections = 0     # per host, 0 for no limit
+    async_requests = 0
+    multipart_journal_dir = ""
     add_headers = ""
 
     ## Creating a singleton
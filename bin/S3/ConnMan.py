@@ -1,6 +1,9 @@
 import httplib
+import select
+import socket
+import time
 from urlparse import urlparse
-from threading import Semaphore
+from threading import Condition
 from logging import debug, info, warning, error
 
 from Config import Config
@@ -14,6 +17,7 @@ class http_connection(object):
         self.ssl = ssl
         self.id = id
         self.counter = 0
+        self.last_used = time.time()
         if cfg.proxy_host != "":
             self.c = httplib.HTTPConnection(cfg.proxy_host, cfg.proxy_port)
         elif not ssl:
@@ -21,10 +25,23 @@ class http_connection(object):
         else:
             self.c = httplib.HTTPSConnection(hostname)
 
+    def is_alive(self):
+        """False if the server has closed this idle connection"""
+        if self.c.sock is None:
+            return False
+        try:
+            ## Nothing should be readable between requests,
+            ## unless the server has closed it (EOF) or sent junk
+            return not select.select([self.c.sock], [], [], 0)[0]
+        except (select.error, socket.error, ValueError):
+            return False
+
 class ConnMan(object):
-    conn_pool_sem = Semaphore()
-    conn_pool = {}
+    conn_pool_cond = Condition()
+    conn_pool = {}          ## {conn_id: [idle connections]}
+    conn_count = {}         ## {conn_id: open connections, idle or in use}
     conn_max_counter = 800    ## AWS closes connection after some ~90 requests
+    conn_max_idle = 15      ## seconds, S3 closes idle connections after about 20
 
     @staticmethod
     def get(hostname, ssl = None):
@@ -38,34 +55,88 @@ class ConnMan(object):
             conn_id = "proxy://%s:%s" % (cfg.proxy_host, cfg.proxy_port)
         else:
             conn_id = "http%s://%s" % (ssl and "s" or "", hostname)
-        ConnMan.conn_pool_sem.acquire()
-        if not ConnMan.conn_pool.has_key(conn_id):
-            ConnMan.conn_pool[conn_id] = []
-        if len(ConnMan.conn_pool[conn_id]):
-            conn = ConnMan.conn_pool[conn_id].pop()
-            debug("ConnMan.get(): re-using connection: %s#%d" % (conn.id, conn.counter))
-        ConnMan.conn_pool_sem.release()
+        ConnMan.conn_pool_cond.acquire()
+        try:
+            ConnMan._evict_idle()
+            pool = ConnMan.conn_pool.setdefault(conn_id, [])
+            while True:
+                while pool and not conn:
+                    conn = pool.pop()
+                    if not conn.is_alive():
+                        debug("ConnMan.get(): dropping connection closed by server: %s#%d" % (conn.id, conn.counter))
+                        ConnMan._close(conn)
+                        conn = None
+                if conn:
+                    debug("ConnMan.get(): re-using connection: %s#%d" % (conn.id, conn.counter))
+                    break
+                if not cfg.max_connections or ConnMan.conn_count.get(conn_id, 0) < cfg.max_connections:
+                    ConnMan.conn_count[conn_id] = ConnMan.conn_count.get(conn_id, 0) + 1
+                    break
+                ## Wait for one to be put back or closed. With a timeout,
+                ## or Ctrl-C wouldn't get through.
+                ConnMan.conn_pool_cond.wait(1)
+        finally:
+            ConnMan.conn_pool_cond.release()
         if not conn:
             debug("ConnMan.get(): creating new connection: %s" % conn_id)
             conn = http_connection(conn_id, hostname, ssl, cfg)
-            conn.c.connect()
+            try:
+                conn.c.connect()
+            except:
+                ConnMan.close(conn)
+                raise
         conn.counter += 1
         return conn
 
     @staticmethod
     def put(conn):
         if conn.id.startswith("proxy://"):
-            conn.c.close()
+            ConnMan.close(conn)
             debug("ConnMan.put(): closing proxy connection (keep-alive not yet supported)")
             return
 
         if conn.counter >= ConnMan.conn_max_counter:
-            conn.c.close()
+            ConnMan.close(conn)
             debug("ConnMan.put(): closing over-used connection")
             return
 
-        ConnMan.conn_pool_sem.acquire()
-        ConnMan.conn_pool[conn.id].append(conn)
-        ConnMan.conn_pool_sem.release()
+        if conn.c.sock is None:
+            ## The server asked to close it
+            ConnMan.close(conn)
+            debug("ConnMan.put(): connection closed by server")
+            return
+
+        conn.last_used = time.time()
+        ConnMan.conn_pool_cond.acquire()
+        try:
+            ConnMan.conn_pool[conn.id].append(conn)
+            ConnMan.conn_pool_cond.notify()
+        finally:
+            ConnMan.conn_pool_cond.release()
         debug("ConnMan.put(): connection put back to pool (%s#%d)" % (conn.id, conn.counter))
 
+    @staticmethod
+    def close(conn):
+        """Close a connection taken with get() that can't be put back, e.g. after an error"""
+        ConnMan.conn_pool_cond.acquire()
+        try:
+            ConnMan._close(conn)
+        finally:
+            ConnMan.conn_pool_cond.release()
+
+    @staticmethod
+    def _close(conn):
+        ## Called with conn_pool_cond held
+        conn.c.close()
+        ConnMan.conn_count[conn.id] -= 1
+        ConnMan.conn_pool_cond.notify()
+
+    @staticmethod
+    def _evict_idle():
+        ## Called with conn_pool_cond held
+        oldest = time.time() - ConnMan.conn_max_idle
+        for pool in ConnMan.conn_pool.values():
+            while pool and pool[0].last_used < oldest:
+                conn = pool.pop(0)
+                debug("ConnMan: closing idle connection: %s#%d" % (conn.id, conn.counter))
+                ConnMan._close(conn)
@@ -4,13 +4,121 @@
 ## License: GPL Version 2
 
 from SortedDict import SortedDict
+from array import array
+import binascii
+import threading
 import Utils
 
+class FileEntry(object):
+    """
+    Compact record for one file in a FileDict.
+
+    Fields known to the subclass are kept in __slots__, anything else
+    a command attaches (e.g. 'remote_uri') in a small dict created on
+    demand. Supports the dict operations used on file list entries.
+    """
+    __slots__ = ('_extra',)
+    _fields = frozenset()
+    _defaults = {}
+
+    def __init__(self, **kwargs):
+        self._extra = None
+        for key in kwargs:
+            self[key] = kwargs[key]
+
+    def __getitem__(self, key):
+        if key in self._fields:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                pass
+        elif self._extra is not None and key in self._extra:
+            return self._extra[key]
+        ## Keys every entry of the kind has, e.g. 'dev' of remote files
+        if key in self._defaults:
+            return self._defaults[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in self._fields:
+            setattr(self, key, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        try:
+            if key in self._fields:
+                delattr(self, key)
+            else:
+                del self._extra[key]
+        except (AttributeError, KeyError, TypeError):
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        try:
+            self[key]
+            return True
+        except KeyError:
+            return False
+    has_key = __contains__
+
+    def get(self, key, default = None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        keys = [key for key in self._fields if key in self]
+        if self._extra:
+            keys.extend(self._extra.keys())
+        keys.extend([key for key in self._defaults if key not in keys])
+        return keys
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def update(self, mapping):
+        for key in mapping.keys():
+            self[key] = mapping[key]
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, dict(self.items()))
+
+class LocalFile(FileEntry):
+    """Local file, with the os.lstat() fields s3cmd uses"""
+    __slots__ = ('full_name', 'size', 'mtime', 'dev', 'inode', 'uid', 'gid',
+                 'mode', 'atime', 'ctime', 'md5')
+    _fields = frozenset(__slots__)
+
+    def __getitem__(self, key):
+        ## Not stored, saves a second copy of every path
+        if key == 'full_name_unicode':
+            return Utils.unicodise(self.full_name)
+        return FileEntry.__getitem__(self, key)
+
+    def keys(self):
+        return FileEntry.keys(self) + ['full_name_unicode']
+
+class RemoteFile(FileEntry):
+    """S3 object from a bucket listing"""
+    __slots__ = ('size', 'timestamp', 'md5', 'object_key', 'object_uri_str', 'base_uri')
+    _fields = frozenset(__slots__)
+    _defaults = { 'dev' : None, 'inode' : None }
+
 class FileDict(SortedDict):
     def __init__(self, mapping = {}, ignore_case = True, **kwargs):
         SortedDict.__init__(self, mapping = mapping, ignore_case = ignore_case, **kwargs)
         self.hardlinks = dict() # { dev: { inode : {'md5':, 'relative_files':}}}
         self.by_md5 = dict() # {md5: set(relative_files)}
+        self.hash_cache = None # HashCache for MD5 sums computed by get_md5()
+        self.hash_cache_updated = False
+        self.md5_lock = threading.Lock() # get_md5() is called from --parallel workers
 
     def record_md5(self, relative_file, md5):
         if md5 not in self.by_md5:
@@ -25,14 +133,38 @@ class FileDict(SortedDict):
 
     def get_md5(self, relative_file):
         """returns md5 if it can, or raises IOError if file is unreadable"""
-        md5 = None
-        if 'md5' in self[relative_file]:
-            return self[relative_file]['md5']
-        md5 = self.get_hardlink_md5(relative_file)
-        if md5 is None:
-            md5 = Utils.hash_file_md5(self[relative_file]['full_name'])
-        self.record_md5(relative_file, md5)
-        self[relative_file]['md5'] = md5
+        item = self[relative_file]
+        self.md5_lock.acquire()
+        try:
+            if 'md5' in item:
+                return item['md5']
+            md5 = self.get_hardlink_md5(relative_file)
+            use_cache = self.hash_cache is not None and item.get('inode') is not None
+            if md5 is None and use_cache:
+                ## Another process sharing the cache may have hashed it by now
+                md5 = self.hash_cache.md5(item['dev'], item['inode'], item['mtime'], item['size'])
+        finally:
+            self.md5_lock.release()
+
+        ## Hash without the lock, so that workers can read files in parallel
+        hashed = md5 is None
+        if hashed:
+            md5 = Utils.hash_file_md5(item['full_name'])
+
+        self.md5_lock.acquire()
+        try:
+            if 'md5' in item:
+                ## Another worker got there first
+                return item['md5']
+            if use_cache:
+                if hashed:
+                    self.hash_cache.add(item['dev'], item['inode'], item['mtime'], item['size'], md5)
+                    self.hash_cache_updated = True
+                self.record_hardlink(relative_file, item['dev'], item['inode'], md5)
+            self.record_md5(relative_file, md5)
+            item['md5'] = md5
+        finally:
+            self.md5_lock.release()
         return md5
 
     def record_hardlink(self, relative_file, dev, inode, md5):
@@ -51,3 +183,130 @@ class FileDict(SortedDict):
         except:
             pass
         return md5
+
+class _ColumnarEntry(FileEntry):
+    """Row of a ColumnarFileDict, reading and writing through to its columns"""
+    __slots__ = ('_columns', '_index')
+    _fields = frozenset(['size', 'timestamp', 'md5', 'object_key', 'object_uri_str', 'base_uri'])
+    _defaults = RemoteFile._defaults
+
+    def __init__(self, columns, index):
+        self._columns = columns
+        self._index = index
+        self._extra = columns.extras.get(index)
+
+    def __getitem__(self, key):
+        if key in self._fields:
+            return self._columns.get_field(self._index, key)
+        if self._extra is not None and key in self._extra:
+            return self._extra[key]
+        if key in self._defaults:
+            return self._defaults[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in self._fields:
+            self._columns.set_field(self._index, key, value)
+        else:
+            if self._extra is None:
+                self._extra = self._columns.extras.setdefault(self._index, {})
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key in self._fields:
+            raise KeyError(key)
+        FileEntry.__delitem__(self, key)
+
+class ColumnarFileDict(FileDict):
+    """
+    FileDict for big remote listings. Sizes, timestamps and MD5 sums
+    are stored in arrays, object keys and URIs are derived from the
+    listing prefix, and entries are built when they are looked up.
+    """
+    def __init__(self, base_uri, key_prefix = "", ignore_case = False):
+        FileDict.__init__(self, ignore_case = ignore_case)
+        self.base_uri = base_uri
+        self.base_uri_str = base_uri.uri()
+        self.key_prefix = key_prefix
+        self.names = []
+        self.sizes = array('d')         # 'd' holds any size exactly, 'l' is 32 bit on some platforms
+        self.timestamps = array('d')
+        self.digests = array('c')       # 16 bytes per row, MD5 digest of the ETag
+        self.odd_md5s = {}              # {index: md5} for ETags that aren't plain MD5 sums (multipart)
+        self.extras = {}                # {index: dict} for fields set by commands
+
+    def add_object(self, key, size, timestamp, md5):
+        index = len(self.names)
+        self.names.append(key)
+        self.sizes.append(size)
+        self.timestamps.append(timestamp)
+        if len(md5) == 32:
+            try:
+                self.digests.fromstring(binascii.unhexlify(md5))
+            except TypeError:
+                self.digests.fromstring("\0" * 16)
+                self.odd_md5s[index] = md5
+        else:
+            self.digests.fromstring("\0" * 16)
+            self.odd_md5s[index] = md5
+        SortedDict.__setitem__(self, key, index)
+        self.record_md5(key, md5)
+
+    def get_field(self, index, field):
+        if field == 'size':
+            return int(self.sizes[index])
+        elif field == 'timestamp':
+            return self.timestamps[index]
+        elif field == 'md5':
+            if index in self.odd_md5s:
+                return self.odd_md5s[index]
+            return binascii.hexlify(self.digests[index * 16:index * 16 + 16].tostring())
+        elif field == 'object_key':
+            return self.key_prefix + self.names[index]
+        elif field == 'object_uri_str':
+            return self.base_uri_str + self.names[index]
+        elif field == 'base_uri':
+            return self.base_uri
+        raise KeyError(field)
+
+    def set_field(self, index, field, value):
+        if field == 'size':
+            self.sizes[index] = value
+        elif field == 'timestamp':
+            self.timestamps[index] = value
+        elif field == 'md5':
+            self.odd_md5s[index] = value
+        else:
+            raise KeyError(field)
+
+    def _entry(self, value):
+        if type(value) is int:
+            return _ColumnarEntry(self, value)
+        return value
+
+    def __getitem__(self, key):
+        return self._entry(SortedDict.__getitem__(self, key))
+
+    def __setitem__(self, key, value):
+        if isinstance(value, _ColumnarEntry) and value._columns is self:
+            value = value._index
+        SortedDict.__setitem__(self, key, value)
+
+    def get(self, key, default = None):
+        if key in self:
+            return self[key]
+        return default
+
+    def values(self):
+        return [self[key] for key in self.keys()]
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def itervalues(self):
+        for key in self.keys():
+            yield self[key]
+
+    def iteritems(self):
+        for key in self.keys():
+            yield key, self[key]
@@ -6,7 +6,7 @@
 from S3 import S3
 from Config import Config
 from S3Uri import S3Uri
-from FileDict import FileDict
+from FileDict import FileDict, ColumnarFileDict, LocalFile, RemoteFile
 from Utils import *
 from Exceptions import ParameterError
 from HashCache import HashCache
@@ -16,8 +16,9 @@ from logging import debug, info, warning, error
 import os
 import glob
 import copy
+from collections import deque
 
-__all__ = ["fetch_local_list", "fetch_remote_list", "compare_filelists", "filter_exclude_include", "parse_attrs_header"]
+__all__ = ["fetch_local_list", "fetch_remote_list", "compare_filelists", "diff_filelists", "Md5Index", "filter_exclude_include", "parse_attrs_header"]
 
 def _fswalk_follow_symlinks(path):
     '''
@@ -43,6 +44,8 @@ def _fswalk_follow_symlinks(path):
     for walkdir in walkdirs:
         for dirpath, dirnames, filenames in os.walk(walkdir):
             handle_exclude_include_walk(dirpath, dirnames, [])
+            dirnames.sort()
+            filenames.sort()
             yield (dirpath, dirnames, filenames)
 
 def _fswalk_no_symlinks(path):
@@ -53,6 +56,9 @@ def _fswalk_no_symlinks(path):
     '''
     for dirpath, dirnames, filenames in os.walk(path):
         handle_exclude_include_walk(dirpath, dirnames, filenames)
+        ## Walk in name order, so file lists are built almost sorted
+        dirnames.sort()
+        filenames.sort()
         yield (dirpath, dirnames, filenames)
 
 def filter_exclude_include(src_list):
@@ -140,17 +146,12 @@ def handle_exclude_include_walk(root, dirs, files):
         else:
             debug(u"PASS: %r" % (file))
 
-def fetch_local_list(args, recursive = None):
+def fetch_local_list(args, recursive = None, defer_md5 = None):
     def _get_filelist_local(loc_list, local_uri, cache):
         info(u"Compiling list of local files...")
 
         if deunicodise(local_uri.basename()) == "-":
-            loc_list["-"] = {
-                'full_name_unicode' : '-',
-                'full_name' : '-',
-                'size' : -1,
-                'mtime' : -1,
-            }
+            loc_list["-"] = LocalFile(full_name = '-', size = -1, mtime = -1)
             return loc_list, True
         if local_uri.isdir():
             local_base = deunicodise(local_uri.basename())
@@ -165,6 +166,7 @@ def fetch_local_list(args, recursive = None):
             local_path = deunicodise(local_uri.dirname())
             filelist = [( local_path, [], [deunicodise(local_uri.basename())] )]
             single_file = True
+        to_hash = []
         for root, dirs, files in filelist:
             rel_root = root.replace(local_path, local_base, 1)
             for f in files:
@@ -183,29 +185,67 @@ def fetch_local_list(args, recursive = None):
                 if relative_file.startswith('./'):
                     relative_file = relative_file[2:]
                 sr = os.stat_result(os.lstat(full_name))
-                loc_list[relative_file] = {
-                    'full_name_unicode' : unicodise(full_name),
-                    'full_name' : full_name,
-                    'size' : sr.st_size,
-                    'mtime' : sr.st_mtime,
-                    'dev'   : sr.st_dev,
-                    'inode' : sr.st_ino,
-                    'uid' : sr.st_uid,
-                    'gid' : sr.st_gid,
-                    'sr': sr # save it all, may need it in preserve_attrs_list
-                    ## TODO: Possibly more to save here...
-                }
+                ## Everything preserve_attrs_list may need
+                loc_list[relative_file] = LocalFile(
+                    full_name = full_name,
+                    size = sr.st_size,
+                    mtime = sr.st_mtime,
+                    dev = sr.st_dev,
+                    inode = sr.st_ino,
+                    uid = sr.st_uid,
+                    gid = sr.st_gid,
+                    mode = sr.st_mode,
+                    atime = sr.st_atime,
+                    ctime = sr.st_ctime,
+                )
                 if 'md5' in cfg.sync_checks:
                     md5 = cache.md5(sr.st_dev, sr.st_ino, sr.st_mtime, sr.st_size)
                     if md5 is None:
-                            try:
-                                md5 = loc_list.get_md5(relative_file) # this does the file I/O
-                            except IOError:
-                                continue
-                            cache.add(sr.st_dev, sr.st_ino, sr.st_mtime, sr.st_size, md5)
+                        ## Hashed after the walk, see _hash_local_files(),
+                        ## or on demand by FileDict.get_md5() if deferred
+                        if not defer_md5:
+                            to_hash.append(relative_file)
+                        continue
                     loc_list.record_hardlink(relative_file, sr.st_dev, sr.st_ino, md5)
+        _hash_local_files(loc_list, to_hash, cache)
         return loc_list, single_file
 
+    def _hash_local_files(loc_list, to_hash, cache):
+        ## Hash the cache misses in parallel. Hard links to
+        ## the same inode are only read once.
+        if not to_hash:
+            return
+        if cfg.cache_file:
+            ## Pick up anything hashed by other processes during the walk
+            cache.refresh()
+        by_inode = {}
+        for relative_file in to_hash:
+            item = loc_list[relative_file]
+            md5 = cache.md5(item['dev'], item['inode'], item['mtime'], item['size'])
+            if md5 is not None:
+                loc_list.record_hardlink(relative_file, item['dev'], item['inode'], md5)
+                continue
+            by_inode.setdefault((item['dev'], item['inode']), []).append(relative_file)
+        if not by_inode:
+            return
+        jobs = [(key, loc_list[files[0]]['full_name']) for key, files in by_inode.items()]
+        info(u"Computing MD5 sums of %d local files..." % len(jobs))
+        hashed = 0
+        for (dev, inode), md5 in hash_files_md5(jobs, cfg.hash_workers):
+            if md5 is None:
+                continue
+            hashed += 1
+            if cfg.cache_file and hashed % 1000 == 0:
+                ## Share progress with other processes using the cache
+                cache.save(cfg.cache_file)
+            files = by_inode[(dev, inode)]
+            item = loc_list[files[0]]
+            cache.add(dev, inode, item['mtime'], item['size'], md5)
+            for relative_file in files:
+                loc_list[relative_file]['md5'] = md5
+                loc_list.record_md5(relative_file, md5)
+                loc_list.record_hardlink(relative_file, dev, inode, md5)
+
     def _maintain_cache(cache, local_list):
         if cfg.cache_file:
             cache.mark_all_for_purge()
@@ -233,6 +273,11 @@ def fetch_local_list(args, recursive = None):
     if recursive == None:
         recursive = cfg.recursive
 
+    if defer_md5 == None:
+        defer_md5 = cfg.defer_md5
+    if defer_md5:
+        local_list.hash_cache = cache
+
     for arg in args:
         uri = S3Uri(arg)
         if not uri.type == 'file':
@@ -276,7 +321,6 @@ def fetch_remote_list(args, require_attribs = False, recursive = None):
         info(u"Retrieving list of remote files for %s ..." % remote_uri)
 
         s3 = S3(Config())
-        response = s3.bucket_list(remote_uri.bucket(), prefix = remote_uri.object(), recursive = recursive)
 
         rem_base_original = rem_base = remote_uri.object()
         remote_uri_original = remote_uri
@@ -284,32 +328,25 @@ def fetch_remote_list(args, require_attribs = False, recursive = None):
             rem_base = rem_base[:rem_base.rfind('/')+1]
             remote_uri = S3Uri("s3://%s/%s" % (remote_uri.bucket(), rem_base))
         rem_base_len = len(rem_base)
-        rem_list = FileDict(ignore_case = False)
-        break_now = False
-        for object in response['list']:
+        rem_list = ColumnarFileDict(remote_uri, rem_base)
+        for object in s3.iter_bucket(remote_uri_original.bucket(), prefix = rem_base_original, recursive = recursive):
             if object['Key'] == rem_base_original and object['Key'][-1] != os.path.sep:
                 ## We asked for one file and we got that file :-)
                 key = os.path.basename(object['Key'])
-                object_uri_str = remote_uri_original.uri()
-                break_now = True
                 rem_list = FileDict(ignore_case = False)   ## Remove whatever has already been put to rem_list
-            else:
-                key = object['Key'][rem_base_len:]      ## Beware - this may be '' if object['Key']==rem_base !!
-                object_uri_str = remote_uri.uri() + key
-            rem_list[key] = {
-                'size' : int(object['Size']),
-                'timestamp' : dateS3toUnix(object['LastModified']), ## Sadly it's upload time, not our lastmod time :-(
-                'md5' : object['ETag'][1:-1],
-                'object_key' : object['Key'],
-                'object_uri_str' : object_uri_str,
-                'base_uri' : remote_uri,
-                'dev' : None,
-                'inode' : None,
-            }
-            md5 = object['ETag'][1:-1]
-            rem_list.record_md5(key, md5)
-            if break_now:
+                rem_list[key] = RemoteFile(
+                    size = int(object['Size']),
+                    timestamp = dateS3toUnix(object['LastModified']),
+                    md5 = object['ETag'][1:-1],
+                    object_key = object['Key'],
+                    object_uri_str = remote_uri_original.uri(),
+                    base_uri = remote_uri,
+                )
+                rem_list.record_md5(key, object['ETag'][1:-1])
                 break
+            key = object['Key'][rem_base_len:]      ## Beware - this may be '' if object['Key']==rem_base !!
+            ## Sadly timestamp is upload time, not our lastmod time :-(
+            rem_list.add_object(key, int(object['Size']), dateS3toUnix(object['LastModified']), object['ETag'][1:-1])
         return rem_list
 
     cfg = Config()
@@ -328,7 +365,10 @@ def fetch_remote_list(args, require_attribs = False, recursive = None):
             raise ParameterError("Expecting S3 URI instead of '%s'" % arg)
         remote_uris.append(uri)
 
-    if recursive:
+    if recursive and len(remote_uris) == 1:
+        ## Use the listing as it is, no need for a copy
+        remote_list = _get_filelist_remote(remote_uris[0])
+    elif recursive:
         for uri in remote_uris:
             objectlist = _get_filelist_remote(uri)
             for key in objectlist:
@@ -388,6 +428,109 @@ def parse_attrs_header(attrs_header):
     return attrs
 
 
+def _iter_sorted(file_list):
+    """Stream of (key, item) from a FileDict, sorted by key"""
+    if file_list.ignore_case:
+        ## Sorted ignoring case, the merge needs plain order
+        keys = file_list.keys()
+        keys.sort()
+    else:
+        ## Already in plain order - iterate the FileDict's own key
+        ## list, which entries deleted meanwhile don't change
+        keys = file_list
+    for key in keys:
+        yield key, file_list[key]
+
+class Md5Index(object):
+    """
+    Bounded md5 -> key index for copy detection in diff_filelists(),
+    forgetting the oldest entries beyond 'limit'. Has the same lookup
+    methods as FileDict.
+    """
+    def __init__(self, limit = 100000):
+        self.limit = limit
+        self.keys = {}
+        self.order = deque()
+
+    def record_md5(self, key, md5):
+        if md5 in self.keys:
+            return
+        self.keys[md5] = key
+        self.order.append(md5)
+        if len(self.order) > self.limit:
+            del self.keys[self.order.popleft()]
+
+    def find_md5_one(self, md5):
+        return self.keys.get(md5)
+
+def diff_filelists(src, dst, same, src_md5, md5_index = None):
+    """
+    diff_filelists(src, dst, same, src_md5, md5_index) -> iterator of actions
+
+    Merge-join two streams of (key, item) tuples, both sorted by key,
+    yielding (action, key, src_item, other) as soon as each key is decided:
+      'skip'    same(key, src_item, dst_item) says both sides match, other is dst_item
+      'update'  key exists on both sides but differs, other is dst_item
+      'copy'    src_item can be copied from destination key 'other'
+      'upload'  key only exists in src
+      'delete'  key only exists in dst, src_item is None, other is dst_item
+
+    src_md5(key, src_item) returns an MD5 for copy detection, or None.
+    md5_index (default: a bounded Md5Index) is fed the MD5 sums of
+    destination files as they stream past and of files to be transferred.
+    """
+    if md5_index is None:
+        md5_index = Md5Index()
+
+    def _transfer(key, src_item, dst_item):
+        md5 = src_md5(key, src_item)
+        if md5 is not None:
+            dst1 = md5_index.find_md5_one(md5)
+            if dst1 is not None and dst1 != key:
+                return 'copy', dst1
+            ## Later files with the same content can be copied from this one
+            md5_index.record_md5(key, md5)
+        if dst_item is None:
+            return 'upload', None
+        return 'update', dst_item
+
+    src = iter(src)
+    dst = iter(dst)
+    src_next = next_item(src)
+    dst_next = next_item(dst)
+    while src_next is not None or dst_next is not None:
+        if dst_next is not None and (src_next is None or dst_next[0] < src_next[0]):
+            key, dst_item = dst_next
+            if dst_item.get('md5'):
+                md5_index.record_md5(key, dst_item['md5'])
+            yield 'delete', key, None, dst_item
+            dst_next = next_item(dst)
+        elif dst_next is None or src_next[0] < dst_next[0]:
+            key, src_item = src_next
+            debug(u"CHECK: %s" % key)
+            action, other = _transfer(key, src_item, None)
+            yield action, key, src_item, other
+            src_next = next_item(src)
+        else:
+            key, src_item = src_next
+            dst_item = dst_next[1]
+            debug(u"CHECK: %s" % key)
+            if dst_item.get('md5'):
+                md5_index.record_md5(key, dst_item['md5'])
+            if same(key, src_item, dst_item):
+                yield 'skip', key, src_item, dst_item
+            else:
+                action, other = _transfer(key, src_item, dst_item)
+                yield action, key, src_item, other
+            src_next = next_item(src)
+            dst_next = next_item(dst)
+
+def next_item(iterator):
+    try:
+        return iterator.next()
+    except StopIteration:
+        return None
+
 def compare_filelists(src_list, dst_list, src_remote, dst_remote, delay_updates = False):
     def __direction_str(is_remote):
         return is_remote and "remote" or "local"
@@ -428,6 +571,18 @@ def compare_filelists(src_list, dst_list, src_remote, dst_remote, delay_updates
 
         return attribs_match
 
+    def _src_md5(file):
+        """MD5 of src_list[file] for copy detection, or None if it can't have a copy"""
+        if cfg.defer_md5 and not src_remote and 'md5' not in src_list[file]:
+            ## Don't hash a local file that no other file has the size of
+            size = src_list[file]['size']
+            if dst_sizes is not None and size not in dst_sizes and src_sizes[size] < 2:
+                return None
+        try:
+            return src_list.get_md5(file)
+        except IOError:
+            return None
+
     # we don't support local->local sync, use 'rsync' or something like that instead ;-)
     assert(not(src_remote == False and dst_remote == False))
 
@@ -442,75 +597,59 @@ def compare_filelists(src_list, dst_list, src_remote, dst_remote, delay_updates
 
     debug("Comparing filelists (direction: %s -> %s)" % (__direction_str(src_remote), __direction_str(dst_remote)))
 
-    for relative_file in src_list.keys():
-        debug(u"CHECK: %s" % (relative_file))
-
-        if dst_list.has_key(relative_file):
-            ## Was --skip-existing requested?
-            if cfg.skip_existing:
-                debug(u"IGNR: %s (used --skip-existing)" % (relative_file))
-                del(src_list[relative_file])
-                del(dst_list[relative_file])
-                continue
-
-            try:
-                same_file = _compare(src_list, dst_list, src_remote, dst_remote, relative_file)
-            except (IOError,OSError), e:
-                debug(u"IGNR: %s (disappeared)" % (relative_file))
-                warning(u"%s: file disappeared, ignoring." % (relative_file))
-                del(src_list[relative_file])
-                del(dst_list[relative_file])
-                continue
-
-            if same_file:
-                debug(u"IGNR: %s (transfer not needed)" % relative_file)
-                del(src_list[relative_file])
+    ## Sizes seen on either side, to find which files might be copies
+    src_sizes = {}
+    for relative_file in src_list:
+        size = src_list[relative_file].get('size')
+        src_sizes[size] = src_sizes.get(size, 0) + 1
+    dst_sizes = set()
+    for relative_file in dst_list:
+        if 'size' not in dst_list[relative_file]:
+            dst_sizes = None
+            break
+        dst_sizes.add(dst_list[relative_file]['size'])
+
+    def _same(relative_file, src_item, dst_item):
+        ## Was --skip-existing requested?
+        if cfg.skip_existing:
+            debug(u"IGNR: %s (used --skip-existing)" % (relative_file))
+            return True
+        try:
+            return _compare(src_list, dst_list, src_remote, dst_remote, relative_file)
+        except (IOError,OSError), e:
+            debug(u"IGNR: %s (disappeared)" % (relative_file))
+            warning(u"%s: file disappeared, ignoring." % (relative_file))
+            return True
+
+    ## Both lists are already in memory, the merge only saves looking
+    ## up each key on the other side. dst_list.by_md5 already knows
+    ## every destination file, so it is the (unbounded) copy index.
+    actions = diff_filelists(_iter_sorted(src_list), _iter_sorted(dst_list), _same,
+                             lambda relative_file, src_item: _src_md5(relative_file),
+                             dst_list)
+
+    for action, relative_file, src_item, other in actions:
+        if action == 'skip':
+            debug(u"IGNR: %s (transfer not needed)" % relative_file)
+            del(src_list[relative_file])
+            del(dst_list[relative_file])
+        elif action == 'copy':
+            debug(u"DST COPY: %s -> %s" % (other, relative_file))
+            copy_pairs.append((src_item, other, relative_file))
+            del(src_list[relative_file])
+            if dst_list.has_key(relative_file):
                 del(dst_list[relative_file])
-
-            else:
-                # look for matching file in src
-                try:
-                    md5 = src_list.get_md5(relative_file)
-                except IOError:
-                    md5 = None
-                if md5 is not None and dst_list.by_md5.has_key(md5):
-                    # Found one, we want to copy
-                    dst1 = list(dst_list.by_md5[md5])[0]
-                    debug(u"DST COPY src: %s -> %s" % (dst1, relative_file))
-                    copy_pairs.append((src_list[relative_file], dst1, relative_file))
-                    del(src_list[relative_file])
-                    del(dst_list[relative_file])
-                else:
-                    # record that we will get this file transferred to us (before all the copies), so if we come across it later again,
-                    # we can copy from _this_ copy (e.g. we only upload it once, and copy thereafter).
-                    dst_list.record_md5(relative_file, md5)
-                    update_list[relative_file] = src_list[relative_file]
-                    del src_list[relative_file]
-                    del dst_list[relative_file]
-
-        else:
-            # dst doesn't have this file
-            # look for matching file elsewhere in dst
-            try:
-                md5 = src_list.get_md5(relative_file)
-            except IOError:
-               md5 = None
-            dst1 = dst_list.find_md5_one(md5)
-            if dst1 is not None:
-                # Found one, we want to copy
-                debug(u"DST COPY dst: %s -> %s" % (dst1, relative_file))
-                copy_pairs.append((src_list[relative_file], dst1, relative_file))
-                del(src_list[relative_file])
-            else:
-                # we don't have this file, and we don't have a copy of this file elsewhere.  Get it.
-                # record that we will get this file transferred to us (before all the copies), so if we come across it later again,
-                # we can copy from _this_ copy (e.g. we only upload it once, and copy thereafter).
-                dst_list.record_md5(relative_file, md5)
-
-    for f in dst_list.keys():
-        if src_list.has_key(f) or update_list.has_key(f):
-            # leave only those not on src_list + update_list
-            del dst_list[f]
+        elif action == 'update':
+            update_list[relative_file] = src_item
+            del(src_list[relative_file])
+            del(dst_list[relative_file])
+        ## 'upload' stays on src_list, 'delete' on dst_list
+
+    ## Save MD5 sums computed on demand (see --defer-md5)
+    for file_list in (src_list, dst_list):
+        if cfg.cache_file and file_list.hash_cache_updated:
+            file_list.hash_cache.save(cfg.cache_file)
+            file_list.hash_cache_updated = False
 
     return src_list, dst_list, update_list, copy_pairs
 
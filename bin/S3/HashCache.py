@@ -1,53 +1,360 @@
 import cPickle as pickle
+import binascii
+import bisect
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+
+from logging import debug, info, warning, error
+
+try:
+    import fcntl
+except ImportError:
+    ## No flock() on Windows - only threads of one process are kept apart
+    fcntl = None
+
+## The cache file is a header followed by fixed size records sorted
+## by (dev, inode, mtime), so it can be memory-mapped and searched
+## without loading it. New entries are appended to "<cache>.log" and
+## merged into the main file from time to time.
+##
+## Several s3cmd processes may share one cache: appends and merges
+## hold an exclusive flock() on "<cache>.lock", readers a shared one.
+## Merges replace the main file with rename() so it can be mapped
+## without locking.
+_MAGIC = "s3cmd-hashcache2"
+_RECORD = struct.Struct("<QQdQ16s")     # dev, inode, mtime, size, md5 digest
+
+## Merge the log once it holds this many records, or 1/8 of the main file
+_MIN_LOG_RECORDS = 1000
+
+## Look for entries saved by other processes at most this often (seconds)
+_REFRESH_INTERVAL = 1.0
+
+class _Records(object):
+    """Sequence of (dev, inode, mtime) keys of a mapped cache file"""
+    def __init__(self, buf):
+        self.buf = buf
+        self.count = max(0, len(buf) - len(_MAGIC)) // _RECORD.size
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        return self.record(i)[:3]
+
+    def record(self, i):
+        if i < 0 or i >= self.count:
+            raise IndexError(i)
+        return _RECORD.unpack_from(self.buf, len(_MAGIC) + i * _RECORD.size)
+
+    def find(self, key):
+        i = bisect.bisect_left(self, key)
+        if i < self.count:
+            record = self.record(i)
+            if record[:3] == key:
+                return record
+        return None
+
+def _map_records(fp):
+    """Map the cache file open as fp, returns (_Records, stamp)"""
+    st = os.fstat(fp.fileno())
+    stamp = (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+    fp.seek(0)
+    if fp.read(len(_MAGIC)) != _MAGIC:
+        return None, stamp
+    if st.st_size <= len(_MAGIC):
+        return _Records(""), stamp
+    return _Records(mmap.mmap(fp.fileno(), 0, access = mmap.ACCESS_READ)), stamp
+
+def _read_log(filename, offset = 0):
+    """
+    Records appended to a log file after offset, returns (records, end offset).
+    A torn record at the end is left for the next read.
+    """
+    records = []
+    try:
+        f = open(filename, "rb")
+    except IOError:
+        return records, 0
+    try:
+        if os.fstat(f.fileno()).st_size < offset:
+            ## Emptied by a merge
+            offset = 0
+        f.seek(offset)
+        data = f.read()
+    finally:
+        f.close()
+    end = len(data) - len(data) % _RECORD.size
+    for pos in range(0, end, _RECORD.size):
+        records.append(_RECORD.unpack_from(data, pos))
+    return records, offset + end
+
+def _lock(f, exclusive):
+    """Lock the cache f, returns a handle for _unlock()"""
+    if fcntl is None:
+        return None
+    try:
+        fp = open(f + ".lock", "a")
+    except IOError, e:
+        warning(u"Unable to lock hash cache %s: %s" % (f, e))
+        return None
+    fcntl.flock(fp.fileno(), exclusive and fcntl.LOCK_EX or fcntl.LOCK_SH)
+    return fp
+
+def _unlock(fp):
+    if fp:
+        fp.close()
 
 class HashCache(object):
     def __init__(self):
-        self.inodes = dict()
+        self.filename = None
+        self.records = _Records("")
+        self.records_stamp = None
+        self.added = dict()     # {(dev, inode, mtime): (size, md5)} not in the main file
+        self.unsaved = []       # keys added since the last save()
+        self.log_count = 0      # records in the log file
+        self.log_offset = 0     # how far the log has been read
+        self.seen = None        # keys still in use, between mark_all_for_purge() and purge()
+        self.purging = False
+        self.rewrite = False    # loaded from an old format file
+        self.refreshed = 0
+        self._lock = threading.Lock()          # held while saving or compacting
+        self._state_lock = threading.Lock()    # guards added, unsaved and what refresh() changes
+        self._compactor = None
+        self._compactor_pid = None
 
     def add(self, dev, inode, mtime, size, md5):
-        if dev not in self.inodes:
-            self.inodes[dev] = dict()
-        if inode not in self.inodes[dev]:
-            self.inodes[dev][inode] = dict()
-        self.inodes[dev][inode][mtime] = dict(md5=md5, size=size)
+        key = (dev, inode, mtime)
+        self._state_lock.acquire()
+        try:
+            self.added[key] = (size, md5)
+            self.unsaved.append(key)
+        finally:
+            self._state_lock.release()
+
+    def _lookup(self, key):
+        if key in self.added:
+            return self.added[key]
+        record = self.records.find(key)
+        if record:
+            return record[3], binascii.hexlify(record[4])
+        return None
 
     def md5(self, dev, inode, mtime, size):
+        key = (dev, inode, mtime)
+        self._state_lock.acquire()
         try:
-            d = self.inodes[dev][inode][mtime]
-            if d['size'] != size:
-                return None
-        except:
+            entry = self._lookup(key)
+            if entry is None and self.filename and time.time() - self.refreshed > _REFRESH_INTERVAL:
+                ## Another process may have hashed it meanwhile
+                self._refresh()
+                entry = self._lookup(key)
+        finally:
+            self._state_lock.release()
+        if entry is None or entry[0] != size:
             return None
-        return d['md5']
+        return entry[1]
 
     def mark_all_for_purge(self):
-        for d in self.inodes.keys():
-            for i in self.inodes[d].keys():
-                for c in self.inodes[d][i].keys():
-                    self.inodes[d][i][c]['purge'] = True
+        ## Entries not unmarked before purge() are dropped
+        ## the next time the cache file is compacted
+        self.seen = set()
+        self.purging = False
 
     def unmark_for_purge(self, dev, inode, mtime, size):
-        d = self.inodes[dev][inode][mtime]
-        if d['size'] == size and 'purge' in d:
-            del self.inodes[dev][inode][mtime]['purge']
+        if self.seen is not None:
+            self.seen.add((dev, inode, mtime))
 
     def purge(self):
-        for d in self.inodes.keys():
-            for i in self.inodes[d].keys():
-                for m in self.inodes[d][i].keys():
-                    if 'purge' in self.inodes[d][i][m]:
-                        del self.inodes[d][i]
-                        break
+        self.purging = self.seen is not None
+
+    def _stale_count(self):
+        live = len([k for k in self.seen if self.records.find(k) is not None])
+        return len(self.records) - live
+
+    def _needs_compaction(self):
+        if self.rewrite:
+            return True
+        threshold = max(_MIN_LOG_RECORDS, len(self.records) // 8)
+        if self.log_count > threshold:
+            return True
+        return self.purging and self._stale_count() > threshold
+
+    def _read_new_log(self):
+        records, self.log_offset = _read_log(self.filename + ".log", self.log_offset)
+        for dev, inode, mtime, size, digest in records:
+            self.added.setdefault((dev, inode, mtime), (size, binascii.hexlify(digest)))
+        return len(records)
+
+    def refresh(self):
+        """Pick up entries saved by other processes since the last look"""
+        self._state_lock.acquire()
+        try:
+            self._refresh()
+        finally:
+            self._state_lock.release()
+
+    def _refresh(self):
+        ## Called with _state_lock held
+        self.refreshed = time.time()
+        lock = _lock(self.filename, exclusive = False)
+        try:
+            try:
+                st = os.stat(self.filename)
+                if (st.st_dev, st.st_ino, st.st_size, st.st_mtime) != self.records_stamp:
+                    ## Merged by another process - remap, the log starts over
+                    fp = open(self.filename, "rb")
+                    try:
+                        records, self.records_stamp = _map_records(fp)
+                    finally:
+                        fp.close()
+                    if records is not None:
+                        self.records = records
+                        self.log_offset = 0
+            except (IOError, OSError):
+                pass
+            self.log_count = max(self.log_count, self._read_new_log())
+        finally:
+            _unlock(lock)
 
     def save(self, f):
-        d = dict(inodes=self.inodes, version=1)
-        f = open(f, 'w')
-        p = pickle.dump(d, f)
-        f.close()
+        self.filename = f
+        self.wait()
+        self._lock.acquire()
+        try:
+            self._state_lock.acquire()
+            try:
+                unsaved = list(self.unsaved)
+                data = "".join([_RECORD.pack(key[0], key[1], key[2], self.added[key][0], binascii.unhexlify(self.added[key][1]))
+                                for key in unsaved])
+            finally:
+                self._state_lock.release()
+            if unsaved:
+                lock = _lock(f, exclusive = True)
+                try:
+                    log = open(f + ".log", "ab")
+                    try:
+                        log.write(data)
+                    finally:
+                        log.close()
+                finally:
+                    _unlock(lock)
+                self._state_lock.acquire()
+                try:
+                    self.log_count += len(unsaved)
+                    ## Keep keys added while writing for the next save()
+                    del self.unsaved[:len(unsaved)]
+                finally:
+                    self._state_lock.release()
+        finally:
+            self._lock.release()
+
+        if self._needs_compaction():
+            ## Merge in the background, the process waits for it before exiting.
+            ## Only purge entries this process loaded, not ones others added since.
+            seen = self.purging and set(self.seen) or None
+            self._compactor = threading.Thread(target = self._compact, args = (f, seen, self.records))
+            self._compactor_pid = os.getpid()
+            self._compactor.start()
+
+    def wait(self):
+        """Wait for a background compaction to finish"""
+        if self._compactor:
+            if self._compactor_pid == os.getpid():
+                self._compactor.join()
+            else:
+                ## Forked while compacting, the parent process finishes it
+                self._lock = threading.Lock()
+            self._compactor = None
+
+    def _compact(self, f, seen, loaded):
+        self._lock.acquire()
+        ## Before taking the flock: refresh() takes them the other way round
+        self._state_lock.acquire()
+        try:
+            entries = dict(self.added)
+        finally:
+            self._state_lock.release()
+        lock = _lock(f, exclusive = True)
+        try:
+            try:
+                ## Merge the current main file, which another process
+                ## may have replaced, with the log and our own entries
+                records = _Records("")
+                try:
+                    fp = open(f, "rb")
+                    try:
+                        records = _map_records(fp)[0] or records
+                    finally:
+                        fp.close()
+                except IOError:
+                    pass
+                for dev, inode, mtime, size, digest in _read_log(f + ".log")[0]:
+                    entries.setdefault((dev, inode, mtime), (size, binascii.hexlify(digest)))
+                keys = sorted(entries)
+
+                fd, tmp_name = tempfile.mkstemp(prefix = ".s3cmd-hashcache.", dir = os.path.dirname(os.path.abspath(f)))
+                out = os.fdopen(fd, "wb")
+                try:
+                    out.write(_MAGIC)
+                    i, j = 0, 0
+                    while i < len(records) or j < len(keys):
+                        record = i < len(records) and records.record(i) or None
+                        if record and (j >= len(keys) or record[:3] < keys[j]):
+                            key, value = record[:3], (record[3], binascii.hexlify(record[4]))
+                            i += 1
+                        else:
+                            key = keys[j]
+                            value = entries[key]
+                            j += 1
+                            if record and record[:3] == key:
+                                i += 1
+                        if seen is not None and key not in seen and loaded.find(key) is not None:
+                            continue
+                        out.write(_RECORD.pack(key[0], key[1], key[2], value[0], binascii.unhexlify(value[1])))
+                finally:
+                    out.close()
+                os.rename(tmp_name, f)
+                open(f + ".log", "wb").close()
+                self.log_count = 0
+                self.rewrite = False
+            except (IOError, OSError), e:
+                warning(u"Unable to compact hash cache %s: %s" % (f, e))
+        finally:
+            _unlock(lock)
+            self._lock.release()
 
     def load(self, f):
-        f = open(f, 'r')
-        d = pickle.load(f)
-        f.close()
+        self.filename = f
+        lock = _lock(f, exclusive = False)
+        try:
+            ## Read the log first, it may exist before the main file does
+            self.log_count = self._read_new_log()
+            self.refreshed = time.time()
+
+            fp = open(f, "rb")
+            try:
+                records, self.records_stamp = _map_records(fp)
+                if records is None:
+                    fp.seek(0)
+                    self._load_pickle(fp)
+                else:
+                    self.records = records
+            finally:
+                fp.close()
+        finally:
+            _unlock(lock)
+
+    def _load_pickle(self, fp):
+        ## Cache written by older s3cmd versions, converted on the next save()
+        d = pickle.load(fp)
         if d.get('version') == 1 and 'inodes' in d:
-            self.inodes = d['inodes']
+            for dev, inodes in d['inodes'].items():
+                for inode, mtimes in inodes.items():
+                    for mtime, entry in mtimes.items():
+                        self.added.setdefault((dev, inode, mtime), (entry['size'], entry['md5']))
+        self.rewrite = True
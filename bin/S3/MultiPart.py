@@ -3,16 +3,103 @@
 ## License: GPL Version 2
 
 import os
+import sys
+import threading
 from stat import ST_SIZE
 from logging import debug, info, warning, error
-from Utils import getTextFromXml, formatSize, unicodise
-from Exceptions import S3UploadError
+from Utils import getTextFromXml, getListFromXml, formatSize, unicodise, deunicodise, map_parallel, mkdir_with_parents
+from Exceptions import S3UploadError, S3Error
+
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
+
+class UploadJournal(object):
+    """
+    Upload ID and finished parts of a multipart upload, kept in a file
+    so that a later run can resume the upload if this one fails.
+
+    The file holds a line identifying the source file and destination,
+    "<upload ID> <chunk size>" and then one "<part number> <md5>" line
+    per part.
+    """
+    def __init__(self, dirname, filename, uri):
+        st = os.stat(filename)
+        self.header = "%s %d %d" % (deunicodise(uri.uri()), st.st_size, int(st.st_mtime))
+        key = md5(os.path.abspath(filename) + "\0" + deunicodise(uri.uri())).hexdigest()
+        self.dirname = dirname
+        self.filename = os.path.join(dirname, key + ".journal")
+        self.lock = threading.Lock()
+
+    def load(self):
+        """
+        Returns (upload_id, chunk_size, {part number: md5}). The parts are
+        None if the source file has changed since, and upload_id is None
+        if there is no journal.
+        """
+        try:
+            f = open(self.filename, "r")
+            try:
+                lines = f.read().split("\n")
+            finally:
+                f.close()
+        except IOError:
+            return None, None, {}
+        upload = lines[1:2] and lines[1].split(" ") or []
+        if len(upload) != 2:
+            return None, None, {}
+        upload_id, chunk_size = upload[0], int(upload[1])
+        if lines[0] != self.header:
+            return upload_id, chunk_size, None
+        parts = {}
+        for line in lines[2:]:
+            fields = line.split(" ")
+            ## The last line may be incomplete
+            if len(fields) == 2 and len(fields[1]) == 32:
+                parts[int(fields[0])] = fields[1]
+        return upload_id, chunk_size, parts
+
+    def start(self, upload_id, chunk_size):
+        if not os.path.isdir(self.dirname):
+            mkdir_with_parents(self.dirname)
+        f = open(self.filename, "w")
+        try:
+            f.write("%s\n%s %d\n" % (self.header, upload_id, chunk_size))
+        finally:
+            f.close()
+
+    def record(self, seq, md5sum):
+        self.lock.acquire()
+        try:
+            f = open(self.filename, "a")
+            try:
+                f.write("%d %s\n" % (seq, md5sum))
+            finally:
+                f.close()
+        finally:
+            self.lock.release()
+
+    def remove(self):
+        try:
+            os.unlink(self.filename)
+        except OSError:
+            pass
 
 class MultiPartUpload(object):
 
     MIN_CHUNK_SIZE_MB = 5       # 5MB
     MAX_CHUNK_SIZE_MB = 5120    # 5GB
     MAX_FILE_SIZE = 42949672960 # 5TB
+    MAX_PARTS = 10000
+
+    ## Adaptive chunks should take about this long to send...
+    TARGET_PART_SECONDS = 10
+    ## ...but be small enough to give each part worker a few parts
+    PARTS_PER_WORKER = 4
+
+    ## Recent upload speed of a single part in bytes/s, shared by all uploads
+    part_speed = None
 
     def __init__(self, s3, file, uri, headers_baseline = {}):
         self.s3 = s3
@@ -20,7 +107,51 @@ class MultiPartUpload(object):
         self.uri = uri
         self.parts = {}
         self.headers_baseline = headers_baseline
-        self.upload_id = self.initiate_multipart_upload()
+        if self.file.name != "<stdin>":
+            self.chunk_size = self.pick_chunk_size(os.stat(self.file.name)[ST_SIZE])
+        else:
+            self.chunk_size = self.s3.config.multipart_chunk_size_mb * 1024 * 1024
+        self.upload_id = None
+        self.journal = None
+        if self.file.name != "<stdin>" and self.s3.config.multipart_journal_dir:
+            try:
+                self.journal = UploadJournal(self.s3.config.multipart_journal_dir, self.file.name, self.uri)
+                self.upload_id = self.resume_multipart_upload()
+            except (IOError, OSError), e:
+                warning(u"Unable to use multipart journal: %s" % e)
+                self.journal = None
+        if not self.upload_id:
+            self.upload_id = self.initiate_multipart_upload()
+            if self.journal:
+                try:
+                    self.journal.start(self.upload_id, self.chunk_size)
+                except (IOError, OSError), e:
+                    warning(u"Unable to use multipart journal: %s" % e)
+                    self.journal = None
+
+    def pick_chunk_size(self, file_size):
+        """
+        Chunk size for a file of file_size bytes. Adaptive chunks are sized
+        to take about TARGET_PART_SECONDS at the speed seen so far (the
+        configured size until then), and small enough to keep all part
+        workers busy. Either way there are never more than MAX_PARTS parts.
+        """
+        MB = 1024 * 1024
+        config = self.s3.config
+        chunk_size = config.multipart_chunk_size_mb * MB
+        if config.multipart_adaptive_chunks:
+            if MultiPartUpload.part_speed:
+                chunk_size = int(MultiPartUpload.part_speed * self.TARGET_PART_SECONDS)
+            if config.part_workers > 1:
+                chunk_size = min(chunk_size, file_size / (config.part_workers * self.PARTS_PER_WORKER))
+            chunk_size = max(chunk_size, self.MIN_CHUNK_SIZE_MB * MB)
+        min_chunk_size = file_size / self.MAX_PARTS + 1
+        if chunk_size < min_chunk_size:
+            debug(u"MultiPart: %d byte chunks needed for %d parts at most" % (min_chunk_size, self.MAX_PARTS))
+            chunk_size = min_chunk_size
+        ## Whole MBs, within the S3 limits
+        chunk_size = (chunk_size + MB - 1) / MB * MB
+        return min(chunk_size, self.MAX_CHUNK_SIZE_MB * MB)
 
     def initiate_multipart_upload(self):
         """
@@ -33,46 +164,109 @@ class MultiPartUpload(object):
         self.upload_id = getTextFromXml(data, "UploadId")
         return self.upload_id
 
+    def resume_multipart_upload(self):
+        """
+        Continue the upload recorded in the journal, if it is still in
+        progress. Parts the server has with the recorded MD5 are kept,
+        the rest will be uploaded again. Returns the upload ID or None.
+        """
+        upload_id, chunk_size, recorded = self.journal.load()
+        if not upload_id:
+            return None
+        if recorded is None:
+            ## The source has changed, its parts are of no use
+            info(u"'%s' has changed since upload %s started, starting over" % (self.file.name, upload_id))
+            try:
+                self.abort_upload(upload_id)
+            except S3Error, e:
+                debug(u"Unable to abort upload %s: %s" % (upload_id, e))
+            return None
+        try:
+            uploaded = self.list_parts(upload_id)
+        except S3Error, e:
+            info(u"Unable to resume upload %s of '%s' (%s), starting over" % (upload_id, self.file.name, e))
+            return None
+        ## Parts are only of use with the same split as before
+        self.chunk_size = chunk_size
+        for seq, etag in uploaded.items():
+            if recorded.get(seq) == etag.strip('"'):
+                self.parts[seq] = etag
+        info(u"Resuming upload of '%s': %d parts already uploaded" % (self.file.name, len(self.parts)))
+        return upload_id
+
+    def list_parts(self, upload_id):
+        """
+        Parts uploaded so far as {part number: etag}
+        http://docs.amazonwebservices.com/AmazonS3/latest/API/mpUploadListParts.html
+        """
+        parts = {}
+        marker = None
+        while True:
+            request = self.s3.create_request("OBJECT_GET", uri = self.uri, extra = "?uploadId=%s" % upload_id, **{ "part-number-marker" : marker })
+            data = self.s3.send_request(request)["data"]
+            for part in getListFromXml(data, "Part"):
+                parts[int(part["PartNumber"])] = part["ETag"]
+            marker = getTextFromXml(data, "NextPartNumberMarker")
+            if (getTextFromXml(data, "IsTruncated") or "false").lower() == "false" or not marker:
+                break
+        return parts
+
     def upload_all_parts(self):
         """
         Execute a full multipart upload on a file
         Returns the seq/etag dict
-        TODO use num_processes to thread it
+        Parts of a file are uploaded by up to config.part_workers threads
         """
         if not self.upload_id:
             raise RuntimeError("Attempting to use a multipart upload that has not been initiated.")
 
-        self.chunk_size = self.s3.config.multipart_chunk_size_mb * 1024 * 1024
-
         if self.file.name != "<stdin>":
                 size_left = file_size = os.stat(self.file.name)[ST_SIZE]
                 nr_parts = file_size / self.chunk_size + (file_size % self.chunk_size and 1)
-                debug("MultiPart: Uploading %s in %d parts" % (self.file.name, nr_parts))
+                debug("MultiPart: Uploading %s in %d parts of %d bytes" % (self.file.name, nr_parts, self.chunk_size))
         else:
             debug("MultiPart: Uploading from %s" % (self.file.name))
 
         seq = 1
         if self.file.name != "<stdin>":
-            while size_left > 0:
+            def _upload(seq):
                 offset = self.chunk_size * (seq - 1)
                 current_chunk_size = min(file_size - offset, self.chunk_size)
-                size_left -= current_chunk_size
                 labels = {
                     'source' : unicodise(self.file.name),
                     'destination' : unicodise(self.uri.uri()),
                     'extra' : "[part %d of %d, %s]" % (seq, nr_parts, "%d%sB" % formatSize(current_chunk_size, human_readable = True))
                 }
+                ## Failures are passed back, so the main thread can abort the upload
                 try:
                     self.upload_part(seq, offset, current_chunk_size, labels)
-                except:
-                    error(u"Upload of '%s' part %d failed. Aborting multipart upload." % (self.file.name, seq))
+                except Exception:
+                    return seq, sys.exc_info()
+                return seq, None
+
+            ## Parts of a resumed upload may be there already
+            todo = [seq for seq in range(1, nr_parts + 1) if seq not in self.parts]
+            try:
+                for seq, exc_info in map_parallel(_upload, todo, self.s3.config.part_workers):
+                    if exc_info:
+                        if self.journal:
+                            error(u"Upload of '%s' part %d failed. Run the command again to resume the upload." % (self.file.name, seq))
+                        else:
+                            error(u"Upload of '%s' part %d failed. Aborting multipart upload." % (self.file.name, seq))
+                        raise exc_info[0], exc_info[1], exc_info[2]
+            except:
+                if not self.journal:
                     self.abort_upload()
-                    raise
-                seq += 1
+                raise
+            seq = nr_parts + 1
         else:
+            offset = 0
             while True:
+                if seq > 1 and seq % (self.MAX_PARTS / 10) == 1:
+                    ## Unknown size - grow the chunks to stay within MAX_PARTS
+                    ## (doubling every 1/10th of it allows for some 15TB)
+                    self.chunk_size = min(self.chunk_size * 2, self.MAX_CHUNK_SIZE_MB * 1024 * 1024)
                 buffer = self.file.read(self.chunk_size)
-                offset = self.chunk_size * (seq - 1)
                 current_chunk_size = len(buffer)
                 labels = {
                     'source' : unicodise(self.file.name),
@@ -87,6 +281,7 @@ class MultiPartUpload(object):
                     error(u"Upload of '%s' part %d failed. Aborting multipart upload." % (self.file.name, seq))
                     self.abort_upload()
                     raise
+                offset += current_chunk_size
                 seq += 1
 
         debug("MultiPart: Upload finished: %d parts", seq - 1)
@@ -101,8 +296,24 @@ class MultiPartUpload(object):
         headers = { "content-length": chunk_size }
         query_string = "?partNumber=%i&uploadId=%s" % (seq, self.upload_id)
         request = self.s3.create_request("OBJECT_PUT", uri = self.uri, headers = headers, extra = query_string)
-        response = self.s3.send_file(request, self.file, labels, buffer, offset = offset, chunk_size = chunk_size)
+        if buffer:
+            response = self.s3.send_file(request, self.file, labels, buffer, offset = offset, chunk_size = chunk_size)
+        else:
+            ## Each part reads through its own file handle, parts may be sent concurrently
+            file = open(self.file.name, "rb")
+            try:
+                response = self.s3.send_file(request, file, labels, offset = offset, chunk_size = chunk_size)
+            finally:
+                file.close()
         self.parts[seq] = response["headers"]["etag"]
+        if response["speed"] > 0:
+            ## Moving average, for sizing the chunks of later uploads
+            if MultiPartUpload.part_speed:
+                MultiPartUpload.part_speed = 0.7 * MultiPartUpload.part_speed + 0.3 * response["speed"]
+            else:
+                MultiPartUpload.part_speed = response["speed"]
+        if self.journal:
+            self.journal.record(seq, response["headers"]["etag"].strip('"\''))
         return response
 
     def complete_multipart_upload(self):
@@ -114,24 +325,30 @@ class MultiPartUpload(object):
 
         parts_xml = []
         part_xml = "<Part><PartNumber>%i</PartNumber><ETag>%s</ETag></Part>"
-        for seq, etag in self.parts.items():
-            parts_xml.append(part_xml % (seq, etag))
+        ## Parts must be listed in ascending order
+        for seq in sorted(self.parts.keys()):
+            parts_xml.append(part_xml % (seq, self.parts[seq]))
         body = "<CompleteMultipartUpload>%s</CompleteMultipartUpload>" % ("".join(parts_xml))
 
         headers = { "content-length": len(body) }
         request = self.s3.create_request("OBJECT_POST", uri = self.uri, headers = headers, extra = "?uploadId=%s" % (self.upload_id))
         response = self.s3.send_request(request, body = body)
+        if self.journal:
+            self.journal.remove()
 
         return response
 
-    def abort_upload(self):
+    def abort_upload(self, upload_id = None):
         """
         Abort multipart upload
         http://docs.amazonwebservices.com/AmazonS3/latest/API/index.html?mpUploadAbort.html
         """
-        debug("MultiPart: Aborting upload: %s" % self.upload_id)
-        request = self.s3.create_request("OBJECT_DELETE", uri = self.uri, extra = "?uploadId=%s" % (self.upload_id))
+        upload_id = upload_id or self.upload_id
+        debug("MultiPart: Aborting upload: %s" % upload_id)
+        request = self.s3.create_request("OBJECT_DELETE", uri = self.uri, extra = "?uploadId=%s" % (upload_id))
         response = self.s3.send_request(request)
+        if self.journal:
+            self.journal.remove()
         return response
 
 # vim:et:ts=4:sts=4:ai
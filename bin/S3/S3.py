@@ -5,11 +5,15 @@
 
 import sys
 import os, os.path
+import base64
+import binascii
 import time
 import httplib
 import logging
 import mimetypes
 import re
+import threading
+import Queue
 from logging import debug, info, warning, error
 from stat import ST_SIZE
 
@@ -28,6 +32,7 @@ from Exceptions import *
 from MultiPart import MultiPartUpload
 from S3Uri import S3Uri
 from ConnMan import ConnMan
+from AsyncTransport import AsyncTransport
 
 try:
     import magic, gzip
@@ -143,9 +148,55 @@ class S3Request(object):
         self.update_timestamp()
         self.sign()
         resource = dict(self.resource)  ## take a copy
-        resource['uri'] += self.format_param_str()
+        param_str = self.format_param_str()
+        if param_str and "?" in resource['uri']:
+            ## Sub-resource already given in 'extra', e.g. ?uploadId=...
+            param_str = "&" + param_str[1:]
+        resource['uri'] += param_str
         return (self.method_string, resource, self.headers)
 
+
+## Pages buffered per shard by S3.bucket_list_sharded()
+_LIST_QUEUE_PAGES = 4
+
+## Delimiter listing pages read to split a listing into shards
+_LIST_DISCOVERY_PAGES = 10
+
+## S3.send_file() reads and sends in pieces growing up to this size
+_SEND_CHUNK_MAX = 1024 * 1024
+
+def _queue_put(queue, item, stop):
+    ## Put item on queue unless the consumer has gone away
+    while not stop.isSet():
+        try:
+            queue.put(item, timeout = 1)
+            return
+        except Queue.Full:
+            pass
+
+def _produce(queue, stop, fetch, *args):
+    ## Run fetch(*args) and pass any exception on to the consumer of queue
+    try:
+        fetch(*args)
+        return True
+    except Exception:
+        _queue_put(queue, sys.exc_info(), stop)
+        return False
+
+def _consume(queue):
+    ## Items put on queue by _produce() up to the final None
+    while True:
+        try:
+            ## With a timeout so that ^C isn't blocked in py2
+            item = queue.get(timeout = 1)
+        except Queue.Empty:
+            continue
+        if item is None:
+            return
+        if type(item) == tuple:
+            raise item[0], item[1], item[2]
+        yield item
+
 class S3(object):
     http_methods = BidirMap(
         GET = 0x01,
@@ -188,6 +239,9 @@ class S3(object):
     ## Maximum attempts of re-issuing failed requests
     _max_retries = 5
 
+    ## object_put_many() reads files whole, only smaller ones are given to it
+    async_put_max_size = 1024 * 1024
+
     def __init__(self, config):
         self.config = config
 
@@ -223,40 +277,161 @@ class S3(object):
         return response
 
     def bucket_list(self, bucket, prefix = None, recursive = None):
-        def _list_truncated(data):
-            ## <IsTruncated> can either be "true" or "false" or be missing completely
-            is_truncated = getTextFromXml(data, ".//IsTruncated") or "false"
-            return is_truncated.lower() != "false"
+        objects = []
+        prefixes = []
+        for response in self.iter_bucket_pages(bucket, prefix, recursive):
+            objects += response['list']
+            prefixes += response['common_prefixes']
+
+        response['list'] = objects
+        response['common_prefixes'] = prefixes
+        return response
+
+    def iter_bucket_pages(self, bucket, prefix = None, recursive = None):
+        """
+        Yields the response for each page of a bucket listing, with the
+        page's objects in response['list'] and its "directories" in
+        response['common_prefixes']. The next page is fetched in the
+        background while the caller works on the current one.
+
+        Recursive listings are sharded with --list-workers above 1.
+        """
+        if (self.config.recursive or recursive) and self.config.list_workers > 1:
+            for response in self._iter_sharded_pages(bucket, prefix):
+                yield response
+            return
+
+        queue = Queue.Queue(1)
+        stop = threading.Event()
+        thread = threading.Thread(target = _produce,
+                                  args = (queue, stop, self._list_pages, bucket, prefix, recursive, queue, stop))
+        thread.setDaemon(True)
+        thread.start()
+        try:
+            for response in _consume(queue):
+                yield response
+        finally:
+            stop.set()
+
+    def iter_bucket(self, bucket, prefix = None, recursive = None):
+        """
+        Yields the objects of a bucket listing in key order, page by page.
+        Common prefixes of a non-recursive listing are skipped, use
+        iter_bucket_pages() to get them.
+        """
+        for response in self.iter_bucket_pages(bucket, prefix, recursive):
+            for object in response['list']:
+                yield object
 
-        def _get_contents(data):
-            return getListFromXml(data, "Contents")
+    def bucket_list_sharded(self, bucket, prefix = None, shards = None, workers = None):
+        """
+        Recursive listing of bucket split into key ranges that are listed
+        concurrently, yields the objects in key order.
+
+        The ranges are split at the given shard prefixes (relative to prefix,
+        e.g. from --list-shards) or at the "directories" found by a
+        delimiter listing of prefix.
+        """
+        for response in self._iter_sharded_pages(bucket, prefix, shards, workers):
+            for object in response['list']:
+                yield object
+
+    def _iter_sharded_pages(self, bucket, prefix = None, shards = None, workers = None):
+        prefix = prefix or ""
+        if workers is None:
+            workers = self.config.list_workers
+        if shards is None and self.config.list_shards:
+            shards = [shard.strip() for shard in self.config.list_shards.split(",") if shard.strip()]
+        if shards is None:
+            bounds = self._list_shard_bounds(bucket, prefix)
+        else:
+            bounds = [unicodise(prefix) + unicodise(shard) for shard in shards]
+        bounds = sorted(set(bounds))
+
+        ## Shard n covers keys in (bounds[n-1], bounds[n]]
+        ranges = zip([None] + bounds, bounds + [None])
+        debug(u"Listing s3://%s/%s in %d shards" % (bucket, prefix, len(ranges)))
+        pages = [Queue.Queue(_LIST_QUEUE_PAGES) for r in ranges]
+        todo = Queue.Queue()
+        for n in range(len(ranges)):
+            todo.put(n)
+        stop = threading.Event()
+
+        def _list_shards():
+            ## Shards are taken in order, so the one being consumed
+            ## always has a thread even when later ones are blocked
+            while not stop.isSet():
+                try:
+                    n = todo.get_nowait()
+                except Queue.Empty:
+                    return
+                if not _produce(pages[n], stop, self._list_pages, bucket, prefix, True, pages[n], stop, ranges[n]):
+                    return
+
+        threads = []
+        for n in range(min(workers, len(ranges))):
+            thread = threading.Thread(target = _list_shards)
+            thread.setDaemon(True)
+            thread.start()
+            threads.append(thread)
 
-        def _get_common_prefixes(data):
-            return getListFromXml(data, "CommonPrefixes")
+        try:
+            for queue in pages:
+                for response in _consume(queue):
+                    yield response
+        finally:
+            stop.set()
 
+    def _list_shard_bounds(self, bucket, prefix):
+        """
+        Common prefixes one level below prefix. Only the first few pages
+        are looked at, the last shard covers whatever follows.
+        """
+        uri_params = { 'delimiter' : "/" }
+        bounds = []
+        for n in range(_LIST_DISCOVERY_PAGES):
+            response = self.bucket_list_noparse(bucket, prefix, True, uri_params)
+            result = parseListResult(response["data"])
+            current_list = result['list']
+            current_prefixes = result['common_prefixes']
+            bounds += [unicodise(p["Prefix"]) for p in current_prefixes]
+            if not result['is_truncated']:
+                break
+            last = result['next_marker'] or max([o["Key"] for o in current_list[-1:]] + [p["Prefix"] for p in current_prefixes[-1:]])
+            uri_params['marker'] = self.urlencode_string(last)
+        return bounds
+
+    def _list_pages(self, bucket, prefix, recursive, queue, stop, key_range = (None, None)):
+        """
+        Put the parsed pages of a listing on queue, followed by None.
+        A recursive listing can be limited to keys in key_range, (lower, upper].
+        """
+        lower, upper = key_range
         uri_params = {}
+        if lower is not None:
+            uri_params['marker'] = self.urlencode_string(lower)
         truncated = True
-        list = []
-        prefixes = []
-
-        while truncated:
+        while truncated and not stop.isSet():
             response = self.bucket_list_noparse(bucket, prefix, recursive, uri_params)
-            current_list = _get_contents(response["data"])
-            current_prefixes = _get_common_prefixes(response["data"])
-            truncated = _list_truncated(response["data"])
+            result = parseListResult(response["data"])
+            current_list = result['list']
+            current_prefixes = result['common_prefixes']
+            truncated = result['is_truncated']
             if truncated:
-                if current_list:
+                if result['next_marker']:
+                    uri_params['marker'] = self.urlencode_string(result['next_marker'])
+                elif current_list:
                     uri_params['marker'] = self.urlencode_string(current_list[-1]["Key"])
                 else:
                     uri_params['marker'] = self.urlencode_string(current_prefixes[-1]["Prefix"])
                 debug("Listing continues after '%s'" % uri_params['marker'])
-
-            list += current_list
-            prefixes += current_prefixes
-
-        response['list'] = list
-        response['common_prefixes'] = prefixes
-        return response
+            if upper is not None and current_list and unicodise(current_list[-1]["Key"]) > upper:
+                current_list = [o for o in current_list if unicodise(o["Key"]) <= upper]
+                truncated = False
+            response['list'] = current_list
+            response['common_prefixes'] = current_prefixes
+            _queue_put(queue, response, stop)
+        _queue_put(queue, None, stop)
 
     def bucket_list_noparse(self, bucket, prefix = None, recursive = None, uri_params = {}):
         if prefix:
@@ -381,7 +556,7 @@ class S3(object):
         else:
             return False
 
-    def object_put(self, filename, uri, extra_headers = None, extra_label = ""):
+    def object_put(self, filename, uri, extra_headers = None, extra_label = "", md5sum = None):
         # TODO TODO
         # Make it consistent with stream-oriented object_get()
         if uri.type != "s3":
@@ -399,6 +574,27 @@ class S3(object):
         except (IOError, OSError), e:
             raise InvalidFileError(u"%s: %s" % (unicodise(filename), e.strerror))
 
+        headers = self._object_put_headers(filename, extra_headers)
+
+        ## Multipart decision
+        multipart = False
+        if not self.config.enable_multipart and filename == "-":
+            raise ParameterError("Multi-part upload is required to upload from stdin")
+        if self.config.enable_multipart:
+            if size > self.config.multipart_chunk_size_mb * 1024 * 1024 or filename == "-":
+                multipart = True
+        if multipart:
+            # Multipart requests are quite different... drop here
+            return self.send_file_multipart(file, headers, uri, size)
+
+        ## Not multipart...
+        headers["content-length"] = size
+        request = self.create_request("OBJECT_PUT", uri = uri, headers = headers)
+        labels = { 'source' : unicodise(filename), 'destination' : unicodise(uri.uri()), 'extra' : extra_label }
+        response = self.send_file(request, file, labels, md5sum = md5sum)
+        return response
+
+    def _object_put_headers(self, filename, extra_headers):
         headers = SortedDict(ignore_case = True)
         if extra_headers:
             headers.update(extra_headers)
@@ -426,30 +622,59 @@ class S3(object):
             headers["x-amz-acl"] = "public-read"
         if self.config.reduced_redundancy:
             headers["x-amz-storage-class"] = "REDUCED_REDUNDANCY"
+        return headers
 
-        ## Multipart decision
-        multipart = False
-        if not self.config.enable_multipart and filename == "-":
-            raise ParameterError("Multi-part upload is required to upload from stdin")
-        if self.config.enable_multipart:
-            if size > self.config.multipart_chunk_size_mb * 1024 * 1024 or filename == "-":
-                multipart = True
-        if multipart:
-            # Multipart requests are quite different... drop here
-            return self.send_file_multipart(file, headers, uri, size)
-
-        ## Not multipart...
-        headers["content-length"] = size
-        request = self.create_request("OBJECT_PUT", uri = uri, headers = headers)
-        labels = { 'source' : unicodise(filename), 'destination' : unicodise(uri.uri()), 'extra' : extra_label }
-        response = self.send_file(request, file, labels)
-        return response
+    def object_put_many(self, jobs):
+        """
+        object_put_many(jobs) -> iterator
 
-    def object_get(self, uri, stream, start_position = 0, extra_label = ""):
+        Upload the files of (key, filename, uri, extra_headers) jobs with
+        send_requests(), yielding (key, response, error) as they finish.
+        Files are read into memory whole, this is for small ones.
+        """
+        failed = []
+        sizes = {}
+        def _requests():
+            for key, filename, uri, extra_headers in jobs:
+                try:
+                    file = open(filename, "rb")
+                    try:
+                        body = file.read()
+                    finally:
+                        file.close()
+                except IOError, e:
+                    failed.append((key, None, InvalidFileError(u"%s: %s" % (unicodise(filename), e.strerror))))
+                    continue
+                headers = self._object_put_headers(filename, extra_headers)
+                headers["content-length"] = sizes[key] = len(body)
+                ## No need to check the ETag, S3 checks the upload against this
+                headers["content-md5"] = base64.encodestring(md5(body).digest()).strip()
+                yield key, self.create_request("OBJECT_PUT", uri = uri, headers = headers), body
+
+        for key, response, error in self.send_requests(_requests()):
+            while failed:
+                yield failed.pop(0)
+            if response:
+                response["size"] = sizes.pop(key)
+                response["speed"] = response["elapsed"] and float(response["size"]) / response["elapsed"] or float(-1)
+            yield key, response, error
+        while failed:
+            yield failed.pop(0)
+
+    def object_get(self, uri, stream, start_position = 0, extra_label = "", size = None):
         if uri.type != "s3":
             raise ValueError("Expected URI type 's3', got '%s'" % uri.type)
         request = self.create_request("OBJECT_GET", uri = uri)
         labels = { 'source' : unicodise(uri.uri()), 'destination' : unicodise(stream.name), 'extra' : extra_label }
+        if start_position == 0 and self.config.part_workers > 1 and os.path.isfile(stream.name):
+            ## Large objects are fetched in segments, written in place.
+            ## The size from the bucket listing saves a HEAD per small object.
+            head = None
+            if size is None:
+                head = self.object_info(uri)
+                size = long(head["headers"]["content-length"])
+            if size > self.config.multipart_chunk_size_mb * 1024 * 1024:
+                return self.recv_file_segmented(uri, stream, head or self.object_info(uri))
         response = self.recv_file(request, stream, labels, start_position)
         return response
 
@@ -460,6 +685,20 @@ class S3(object):
         response = self.send_request(request)
         return response
 
+    def object_delete_many(self, jobs):
+        """
+        object_delete_many(jobs) -> iterator
+
+        Delete the objects of (key, uri) jobs with send_requests(),
+        yielding (key, response, error) as they finish.
+        """
+        def _requests():
+            for key, uri in jobs:
+                if uri.type != "s3":
+                    raise ValueError("Expected URI type 's3', got '%s'" % uri.type)
+                yield key, self.create_request("OBJECT_DELETE", uri = uri), None
+        return self.send_requests(_requests())
+
     def object_copy(self, src_uri, dst_uri, extra_headers = None):
         if src_uri.type != "s3":
             raise ValueError("Expected URI type 's3', got '%s'" % src_uri.type)
@@ -502,6 +741,19 @@ class S3(object):
         acl = ACL(response['data'])
         return acl
 
+    def get_acl_many(self, jobs):
+        """
+        get_acl_many(jobs) -> iterator
+
+        Get the ACLs of the objects of (key, uri) jobs with send_requests(),
+        yielding (key, ACL, error) as they arrive.
+        """
+        def _requests():
+            for key, uri in jobs:
+                yield key, self.create_request("OBJECT_GET", uri = uri, extra = "?acl"), None
+        for key, response, error in self.send_requests(_requests()):
+            yield key, error is None and ACL(response['data']) or None, error
+
     def set_acl(self, uri, acl):
         if uri.has_object():
             request = self.create_request("OBJECT_PUT", uri = uri, extra = "?acl")
@@ -513,6 +765,20 @@ class S3(object):
         response = self.send_request(request, body)
         return response
 
+    def set_acl_many(self, jobs):
+        """
+        set_acl_many(jobs) -> iterator
+
+        Set the ACLs of (key, uri, acl) jobs with send_requests(),
+        yielding (key, response, error) as they finish.
+        """
+        def _requests():
+            for key, uri, acl in jobs:
+                body = str(acl)
+                debug(u"set_acl(%s): acl-xml: %s" % (uri, body))
+                yield key, self.create_request("OBJECT_PUT", uri = uri, extra = "?acl"), body
+        return self.send_requests(_requests())
+
     def get_policy(self, uri):
         request = self.create_request("BUCKET_LIST", bucket = uri.bucket(), extra = "?policy")
         response = self.send_request(request)
@@ -651,11 +917,34 @@ class S3(object):
         # Wait a few seconds. The more it fails the more we wait.
         return (self._max_retries - retries + 1) * 3
 
+    def _drop_connection(self, conn):
+        """
+        Close conn after a failed request. Returns True if it had been
+        used before: the server may have closed it meanwhile, so the
+        request is worth retrying on a new connection right away.
+        """
+        if conn is None:
+            return False
+        ConnMan.close(conn)
+        return conn.counter > 1
+
+    def send_requests(self, jobs):
+        """
+        send_requests(jobs) -> iterator
+
+        Send the requests of (key, request, body) jobs from this thread,
+        with up to config.async_requests of them in flight at once, and
+        yield (key, response, error) as they finish. error is None or
+        the S3Error or S3RequestError the request failed with.
+        """
+        return AsyncTransport(self, self.config.async_requests).run(jobs)
+
     def send_request(self, request, body = None, retries = _max_retries):
         method_string, resource, headers = request.get_triplet()
         debug("Processing request, please wait...")
         if not headers.has_key('content-length'):
             headers['content-length'] = body and len(body) or 0
+        conn = None
         try:
             # "Stringify" all headers
             for header in headers.keys():
@@ -675,6 +964,9 @@ class S3(object):
         except ParameterError, e:
             raise
         except Exception, e:
+            if self._drop_connection(conn):
+                debug("Request failed on a reused connection, reconnecting: %s (%s)" % (resource['uri'], e))
+                return self.send_request(request, body, retries)
             if retries:
                 warning("Retrying failed request: %s (%s)" % (resource['uri'], e))
                 warning("Waiting %d sec..." % self._fail_wait(retries))
@@ -707,7 +999,12 @@ class S3(object):
 
         return response
 
-    def send_file(self, request, file, labels, buffer = '', throttle = 0, retries = _max_retries, offset = 0, chunk_size = -1):
+    def send_file(self, request, file, labels, buffer = '', throttle = 0, retries = _max_retries, offset = 0, chunk_size = -1, md5sum = None):
+        if md5sum:
+            ## Have S3 check the upload against the MD5 we know already
+            request.headers["content-md5"] = base64.encodestring(binascii.unhexlify(md5sum)).strip()
+        elif request.headers.has_key("content-md5"):
+            del(request.headers["content-md5"])
         method_string, resource, headers = request.get_triplet()
         size_left = size_total = headers.get("content-length")
         if self.config.progress_meter:
@@ -715,6 +1012,7 @@ class S3(object):
         else:
             info("Sending file '%s', please wait..." % file.name)
         timestamp_start = time.time()
+        conn = None
         try:
             conn = ConnMan.get(self.get_hostname(resource['bucket']))
             conn.c.putrequest(method_string, self.format_uri(resource))
@@ -726,32 +1024,48 @@ class S3(object):
         except Exception, e:
             if self.config.progress_meter:
                 progress.done("failed")
+            if self._drop_connection(conn):
+                debug("Request failed on a reused connection, reconnecting: %s (%s)" % (resource['uri'], e))
+                return self.send_file(request, file, labels, buffer, throttle, retries, offset, chunk_size, md5sum)
             if retries:
                 warning("Retrying failed request: %s (%s)" % (resource['uri'], e))
                 warning("Waiting %d sec..." % self._fail_wait(retries))
                 time.sleep(self._fail_wait(retries))
                 # Connection error -> same throttle value
-                return self.send_file(request, file, labels, buffer, throttle, retries - 1, offset, chunk_size)
+                return self.send_file(request, file, labels, buffer, throttle, retries - 1, offset, chunk_size, md5sum)
             else:
                 raise S3UploadError("Upload failed for: %s" % resource['uri'])
+        ## Read into one buffer and send slices of it, no copies
         if buffer == '':
             file.seek(offset)
-        md5_hash = md5()
+            read_buffer = memoryview(bytearray(min(size_left, _SEND_CHUNK_MAX)))
+        else:
+            read_buffer = None
+            buffer_view = memoryview(buffer)
+        ## No need to hash what the caller has hashed already
+        md5_hash = md5sum is None and md5() or None
+        send_chunk = self.config.send_chunk
+        buffer_position = 0
         try:
             while (size_left > 0):
-                #debug("SendFile: Reading up to %d bytes from '%s' - remaining bytes: %s" % (self.config.send_chunk, file.name, size_left))
-                if buffer == '':
-                    data = file.read(min(self.config.send_chunk, size_left))
+                #debug("SendFile: Reading up to %d bytes from '%s' - remaining bytes: %s" % (send_chunk, file.name, size_left))
+                if read_buffer is not None:
+                    data = read_buffer[:file.readinto(read_buffer[:min(send_chunk, size_left)])]
                 else:
-                    data = buffer
-                md5_hash.update(data)
+                    data = buffer_view[buffer_position:buffer_position + min(send_chunk, size_left)]
+                    buffer_position += len(data)
+                if md5_hash:
+                    md5_hash.update(data)
                 conn.c.send(data)
                 if self.config.progress_meter:
                     progress.update(delta_position = len(data))
                 size_left -= len(data)
                 if throttle:
                     time.sleep(throttle)
-            md5_computed = md5_hash.hexdigest()
+                else:
+                    ## Fewer, larger reads and sends while nothing holds us back
+                    send_chunk = min(send_chunk * 2, _SEND_CHUNK_MAX)
+            md5_computed = md5sum or md5_hash.hexdigest()
             response = {}
             http_response = conn.c.getresponse()
             response["status"] = http_response.status
@@ -759,13 +1073,16 @@ class S3(object):
             response["headers"] = convertTupleListToDict(http_response.getheaders())
             response["data"] = http_response.read()
             response["size"] = size_total
-            ConnMan.put(conn)
             debug(u"Response: %s" % response)
+            ConnMan.put(conn)
         except ParameterError, e:
             raise
         except Exception, e:
             if self.config.progress_meter:
                 progress.done("failed")
+            if self._drop_connection(conn):
+                debug("Upload failed on a reused connection, reconnecting: %s (%s)" % (resource['uri'], e))
+                return self.send_file(request, file, labels, buffer, throttle, retries, offset, chunk_size, md5sum)
             if retries:
                 if retries < self._max_retries:
                     throttle = throttle and throttle * 5 or 0.01
@@ -774,7 +1091,7 @@ class S3(object):
                 warning("Waiting %d sec..." % self._fail_wait(retries))
                 time.sleep(self._fail_wait(retries))
                 # Connection error -> same throttle value
-                return self.send_file(request, file, labels, buffer, throttle, retries - 1, offset, chunk_size)
+                return self.send_file(request, file, labels, buffer, throttle, retries - 1, offset, chunk_size, md5sum)
             else:
                 debug("Giving up on '%s' %s" % (file.name, e))
                 raise S3UploadError("Upload failed for: %s" % resource['uri'])
@@ -796,7 +1113,7 @@ class S3(object):
             redir_hostname = getTextFromXml(response['data'], ".//Endpoint")
             self.set_hostname(redir_bucket, redir_hostname)
             warning("Redirected to: %s" % (redir_hostname))
-            return self.send_file(request, file, labels, buffer, offset = offset, chunk_size = chunk_size)
+            return self.send_file(request, file, labels, buffer, offset = offset, chunk_size = chunk_size, md5sum = md5sum)
 
         # S3 from time to time doesn't send ETag back in a response :-(
         # Force re-upload here.
@@ -813,13 +1130,16 @@ class S3(object):
                 ## Retriable client error?
                 if err.code in [ 'BadDigest', 'OperationAborted', 'TokenRefreshRequired', 'RequestTimeout' ]:
                     try_retry = True
+                if err.code == 'BadDigest':
+                    ## Changed since it was hashed? Hash what's sent next time.
+                    md5sum = None
 
             if try_retry:
                 if retries:
                     warning("Upload failed: %s (%s)" % (resource['uri'], S3Error(response)))
                     warning("Waiting %d sec..." % self._fail_wait(retries))
                     time.sleep(self._fail_wait(retries))
-                    return self.send_file(request, file, labels, buffer, throttle, retries - 1, offset, chunk_size)
+                    return self.send_file(request, file, labels, buffer, throttle, retries - 1, offset, chunk_size, md5sum)
                 else:
                     warning("Too many failures. Giving up on '%s'" % (file.name))
                     raise S3UploadError
@@ -828,7 +1148,7 @@ class S3(object):
             raise S3Error(response)
 
         debug("MD5 sums: computed=%s, received=%s" % (md5_computed, response["headers"]["etag"]))
-        if response["headers"]["etag"].strip('"\'') != md5_hash.hexdigest():
+        if response["headers"]["etag"].strip('"\'') != md5_computed:
             warning("MD5 Sums don't match!")
             if retries:
                 warning("Retrying upload of %s" % (file.name))
@@ -858,6 +1178,7 @@ class S3(object):
         else:
             info("Receiving file '%s', please wait..." % stream.name)
         timestamp_start = time.time()
+        conn = None
         try:
             conn = ConnMan.get(self.get_hostname(resource['bucket']))
             conn.c.putrequest(method_string, self.format_uri(resource))
@@ -878,6 +1199,9 @@ class S3(object):
         except Exception, e:
             if self.config.progress_meter:
                 progress.done("failed")
+            if self._drop_connection(conn):
+                debug("Request failed on a reused connection, reconnecting: %s (%s)" % (resource['uri'], e))
+                return self.recv_file(request, stream, labels, start_position, retries)
             if retries:
                 warning("Retrying failed request: %s (%s)" % (resource['uri'], e))
                 warning("Waiting %d sec..." % self._fail_wait(retries))
@@ -890,6 +1214,7 @@ class S3(object):
         if response["status"] == 307:
             ## RedirectPermanent
             response['data'] = http_response.read()
+            ConnMan.put(conn)
             redir_bucket = getTextFromXml(response['data'], ".//Bucket")
             redir_hostname = getTextFromXml(response['data'], ".//Endpoint")
             self.set_hostname(redir_bucket, redir_hostname)
@@ -897,6 +1222,8 @@ class S3(object):
             return self.recv_file(request, stream, labels)
 
         if response["status"] < 200 or response["status"] > 299:
+            ## The error body isn't read, the connection can't be reused
+            ConnMan.close(conn)
             raise S3Error(response)
 
         if start_position == 0:
@@ -928,6 +1255,7 @@ class S3(object):
                     progress.update(delta_position = len(data))
             ConnMan.put(conn)
         except Exception, e:
+            ConnMan.close(conn)
             if self.config.progress_meter:
                 progress.done("failed")
             if retries:
@@ -974,6 +1302,155 @@ class S3(object):
             warning("MD5 signatures do not match: computed=%s, received=%s" % (
                 response["md5"], response["headers"]["etag"]))
         return response
+
+    def recv_file_segmented(self, uri, stream, head):
+        """
+        Download uri into the file open as stream with up to
+        config.part_workers concurrent requests, head being the
+        response to object_info(uri). Multipart objects are fetched
+        part by part so that their ETag can be verified, others in
+        ranges of multipart_chunk_size_mb.
+        """
+        size = long(head["headers"]["content-length"])
+        etag = head["headers"]["etag"].strip('"\'')
+        nr_parts = etag.find("-") >= 0 and int(etag.split("-")[1]) or 0
+        if nr_parts:
+            jobs = [(seq, None) for seq in range(1, nr_parts + 1)]
+        else:
+            segment_size = self.config.multipart_chunk_size_mb * 1024 * 1024
+            jobs = [(seq, (offset, min(offset + segment_size, size) - 1))
+                    for seq, offset in enumerate(range(0, size, segment_size), 1)]
+        info("Receiving file '%s' in %d segments, please wait..." % (stream.name, len(jobs)))
+        timestamp_start = time.time()
+
+        ## Preallocate, segments are written at their offsets
+        ## through handles of their own
+        stream.truncate(size)
+        def _get(job):
+            seq, byte_range = job
+            return seq, self.recv_segment(uri, stream.name, seq, byte_range)
+
+        digests = {}
+        received = 0
+        for seq, (length, digest) in map_parallel(_get, jobs, self.config.part_workers):
+            digests[seq] = digest
+            received += length
+        stream.seek(0, 2)
+        timestamp_end = time.time()
+
+        if received != size:
+            raise S3DownloadError("Download failed for: %s (received %d of %d bytes)" % (uri, received, size))
+
+        response = dict(head)
+        if nr_parts:
+            ## A multipart ETag is the MD5 of the MD5s of its parts
+            parts_md5 = md5("".join([digests[seq] for seq in sorted(digests.keys())]))
+            response["md5"] = "%s-%d" % (parts_md5.hexdigest(), nr_parts)
+        else:
+            response["md5"] = hash_file_md5(stream.name)
+        response["md5match"] = etag == response["md5"]
+        response["elapsed"] = timestamp_end - timestamp_start
+        response["size"] = received
+        response["speed"] = response["elapsed"] and float(response["size"]) / response["elapsed"] or float(-1)
+        debug("ReceiveFile: Computed MD5 = %s" % response["md5"])
+        if not response["md5match"]:
+            warning("MD5 signatures do not match: computed=%s, received=%s" % (
+                response["md5"], etag))
+        return response
+
+    def recv_segment(self, uri, filename, seq, byte_range, retries = _max_retries):
+        """
+        Download bytes byte_range = (first, last) of uri, or part seq of a
+        multipart object if byte_range is None, into the same place in
+        the file filename. Returns (size, md5 digest) of the segment.
+        """
+        if byte_range:
+            request = self.create_request("OBJECT_GET", uri = uri)
+        else:
+            request = self.create_request("OBJECT_GET", uri = uri, extra = "?partNumber=%d" % seq)
+        method_string, resource, headers = request.get_triplet()
+        conn = None
+        try:
+            conn = ConnMan.get(self.get_hostname(resource['bucket']))
+            conn.c.putrequest(method_string, self.format_uri(resource))
+            for header in headers.keys():
+                conn.c.putheader(header, str(headers[header]))
+            if byte_range:
+                conn.c.putheader("Range", "bytes=%d-%d" % byte_range)
+            conn.c.endheaders()
+            response = {}
+            http_response = conn.c.getresponse()
+            response["status"] = http_response.status
+            response["reason"] = http_response.reason
+            response["headers"] = convertTupleListToDict(http_response.getheaders())
+            debug("Response: %s" % response)
+        except ParameterError, e:
+            raise
+        except Exception, e:
+            if self._drop_connection(conn):
+                debug("Request failed on a reused connection, reconnecting: %s (%s)" % (resource['uri'], e))
+                return self.recv_segment(uri, filename, seq, byte_range, retries)
+            if retries:
+                warning("Retrying failed request: %s (%s)" % (resource['uri'], e))
+                warning("Waiting %d sec..." % self._fail_wait(retries))
+                time.sleep(self._fail_wait(retries))
+                return self.recv_segment(uri, filename, seq, byte_range, retries - 1)
+            else:
+                raise S3DownloadError("Download failed for: %s" % resource['uri'])
+
+        if response["status"] >= 500:
+            response["data"] = http_response.read()
+            ConnMan.put(conn)
+            e = S3Error(response)
+            if retries:
+                warning(u"Retrying failed request: %s" % resource['uri'])
+                warning(unicode(e))
+                warning("Waiting %d sec..." % self._fail_wait(retries))
+                time.sleep(self._fail_wait(retries))
+                return self.recv_segment(uri, filename, seq, byte_range, retries - 1)
+            else:
+                raise e
+
+        if response["status"] < 200 or response["status"] > 299:
+            response["data"] = http_response.read()
+            ConnMan.put(conn)
+            raise S3Error(response)
+
+        ## Where the segment goes - parts only know once they arrive
+        content_range = re.match("bytes (\d+)-(\d+)/", response["headers"].get("content-range", ""))
+        if not content_range:
+            ConnMan.close(conn)
+            raise S3DownloadError("Download failed for: %s (no Content-Range in response)" % resource['uri'])
+        offset = long(content_range.group(1))
+        size = long(content_range.group(2)) - offset + 1
+
+        md5_hash = md5()
+        try:
+            stream = open(filename, "r+b")
+            try:
+                stream.seek(offset)
+                size_left = size
+                while size_left > 0:
+                    data = http_response.read(min(size_left, self.config.recv_chunk))
+                    if len(data) == 0:
+                        raise S3Error("EOF from S3!")
+                    stream.write(data)
+                    md5_hash.update(data)
+                    size_left -= len(data)
+            finally:
+                stream.close()
+            ConnMan.put(conn)
+        except Exception, e:
+            ConnMan.close(conn)
+            if retries:
+                warning("Retrying failed request: %s (%s)" % (resource['uri'], e))
+                warning("Waiting %d sec..." % self._fail_wait(retries))
+                time.sleep(self._fail_wait(retries))
+                return self.recv_segment(uri, filename, seq, byte_range, retries - 1)
+            else:
+                raise S3DownloadError("Download failed for: %s" % resource['uri'])
+        return size, md5_hash.digest()
+
 __all__.append("S3")
 
 # vim:et:ts=4:sts=4:ai
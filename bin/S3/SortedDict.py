@@ -3,21 +3,15 @@
 ##         http://www.logix.cz/michal
 ## License: GPL Version 2
 
-from BidirMap import BidirMap
 import Utils
 
-class SortedDictIterator(object):
-    def __init__(self, sorted_dict, keys):
-        self.sorted_dict = sorted_dict
-        self.keys = keys
-
-    def next(self):
-        try:
-            return self.keys.pop(0)
-        except IndexError:
-            raise StopIteration
-
 class SortedDict(dict):
+    ## Sorted keys, rebuilt on demand after a key is added. Deleted keys
+    ## are filtered out on the next use. The list is replaced, never
+    ## modified, so running iterators are unaffected.
+    _sorted_keys = None
+    _deleted = False
+
     def __init__(self, mapping = {}, ignore_case = True, **kwargs):
         """
         WARNING: SortedDict() with ignore_case==True will
@@ -28,23 +22,62 @@ class SortedDict(dict):
         dict.__init__(self, mapping, **kwargs)
         self.ignore_case = ignore_case
 
+    def __setitem__(self, key, value):
+        if self._sorted_keys is not None and not dict.__contains__(self, key):
+            self._sorted_keys = None
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._deleted = True
+
+    def setdefault(self, key, default = None):
+        if not dict.__contains__(self, key):
+            self[key] = default
+        return dict.__getitem__(self, key)
+
+    def update(self, *args, **kwargs):
+        dict.update(self, *args, **kwargs)
+        self._sorted_keys = None
+
+    def pop(self, key, *default):
+        self._deleted = True
+        return dict.pop(self, key, *default)
+
+    def popitem(self):
+        self._deleted = True
+        return dict.popitem(self)
+
+    def clear(self):
+        dict.clear(self)
+        self._sorted_keys = None
+
+    def _keys(self):
+        if self._sorted_keys is None:
+            keys = dict.keys(self)
+            if self.ignore_case:
+                # Translation map
+                xlat_map = {}
+                for key in keys:
+                    xlat_map[key.lower()] = key
+                # Lowercase keys
+                lc_keys = xlat_map.keys()
+                lc_keys.sort()
+                keys = [xlat_map[k] for k in lc_keys]
+            else:
+                keys.sort()
+            self._sorted_keys = keys
+            self._deleted = False
+        elif self._deleted:
+            self._sorted_keys = [key for key in self._sorted_keys if dict.__contains__(self, key)]
+            self._deleted = False
+        return self._sorted_keys
+
     def keys(self):
-        keys = dict.keys(self)
-        if self.ignore_case:
-            # Translation map
-            xlat_map = BidirMap()
-            for key in keys:
-                xlat_map[key.lower()] = key
-            # Lowercase keys
-            lc_keys = xlat_map.keys()
-            lc_keys.sort()
-            return [xlat_map[k] for k in lc_keys]
-        else:
-            keys.sort()
-            return keys
+        return list(self._keys())
 
     def __iter__(self):
-        return SortedDictIterator(self, self.keys())
+        return iter(self._keys())
 
 
 
@@ -35,6 +35,20 @@ except ImportError:
     import elementtree.ElementTree as ET
 from xml.parsers.expat import ExpatError
 
+try:
+    ## The C implementation parses listings several times faster
+    import xml.etree.cElementTree as cET
+except ImportError:
+    cET = ET
+
+from cStringIO import StringIO
+
+try:
+    from multiprocessing.pool import ThreadPool
+except ImportError:
+    ## Python 2.5 and older - hash files one at a time
+    ThreadPool = None
+
 __all__ = []
 def parseNodes(nodes):
     ## WARNING: Ignores text nodes from mixed xml/text.
@@ -48,7 +62,7 @@ def parseNodes(nodes):
             if child.getchildren():
                 retval_item[name] = parseNodes([child])
             else:
-                retval_item[name] = node.findtext(".//%s" % child.tag)
+                retval_item[name] = child.text or ""
         retval.append(retval_item)
     return retval
 __all__.append("parseNodes")
@@ -84,6 +98,54 @@ def getListFromXml(xml, node):
     return parseNodes(nodes)
 __all__.append("getListFromXml")
 
+def _localName(tag):
+    ## "{http://s3.amazonaws.com/doc/2006-03-01/}Key" -> "Key"
+    return tag[tag.rfind("}") + 1:]
+
+def _parseElement(elem):
+    ## Same layout as parseNodes() gives for one node
+    item = {}
+    for child in elem:
+        if len(child):
+            item[_localName(child.tag)] = [_parseElement(child)]
+        else:
+            item[_localName(child.tag)] = child.text or ""
+    return item
+
+def parseListResult(xml):
+    """
+    Parse a ListBucketResult page in one pass. Returns a dict with the
+    'list' of Contents and 'common_prefixes' laid out as getListFromXml()
+    returns them, 'is_truncated' and 'next_marker' (None if not given).
+    """
+    result = { 'list' : [], 'common_prefixes' : [], 'is_truncated' : False, 'next_marker' : None }
+    depth = 0
+    try:
+        for event, elem in cET.iterparse(StringIO(xml), events = ("start", "end")):
+            if event == "start":
+                depth += 1
+                continue
+            depth -= 1
+            if depth != 1:
+                ## Only look at direct children of <ListBucketResult>
+                continue
+            name = _localName(elem.tag)
+            if name == "Contents":
+                result['list'].append(_parseElement(elem))
+            elif name == "CommonPrefixes":
+                result['common_prefixes'].append(_parseElement(elem))
+            elif name == "IsTruncated":
+                ## Can be "true" or "false" or be missing completely
+                result['is_truncated'] = (elem.text or "false").lower() != "false"
+            elif name == "NextMarker":
+                result['next_marker'] = elem.text
+            elem.clear()
+    except (ExpatError, SyntaxError), e:
+        error(e)
+        raise Exceptions.ParameterError("Bucket contains invalid filenames. Please run: s3cmd fixbucket s3://your-bucket/")
+    return result
+__all__.append("parseListResult")
+
 def getDictFromTree(tree):
     ret_dict = {}
     for child in tree.getchildren():
@@ -239,6 +301,47 @@ def hash_file_md5(filename):
     return h.hexdigest()
 __all__.append("hash_file_md5")
 
+def hash_files_md5(files, workers = 1):
+    """
+    hash_files_md5(files, workers) -> iterator of (key, md5)
+
+    Hash the files given as a list of (key, filename) tuples using
+    up to 'workers' threads, yielding results in completion order.
+    'md5' is None for files that could not be read.
+    """
+    def _hash(job):
+        key, filename = job
+        try:
+            return key, hash_file_md5(filename)
+        except IOError, e:
+            warning(u"Unable to hash %s: %s" % (unicodise(filename), e.strerror))
+            return key, None
+
+    return map_parallel(_hash, files, workers, chunksize = 16)
+__all__.append("hash_files_md5")
+
+def map_parallel(func, items, workers = 1, chunksize = 1):
+    """
+    map_parallel(func, items, workers) -> iterator
+
+    Call func(item) for each of the list 'items' using up to 'workers'
+    threads, yielding the results in completion order. Exceptions
+    raised by func are re-raised in the caller.
+    """
+    if workers <= 1 or len(items) <= 1 or ThreadPool is None:
+        for item in items:
+            yield func(item)
+        return
+
+    pool = ThreadPool(min(workers, len(items)))
+    try:
+        for result in pool.imap_unordered(func, items, chunksize = chunksize):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+__all__.append("map_parallel")
+
 def mkdir_with_parents(dir_name):
     """
     mkdir_with_parents(dst_dir)
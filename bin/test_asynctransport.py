@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+
+## Tests S3.send_requests() and S3/AsyncTransport.py against a
+## BaseHTTPServer on localhost. Run with: python bin/test_asynctransport.py
+
+import os
+import sys
+import threading
+import unittest
+import BaseHTTPServer
+import SocketServer
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from S3.Exceptions import S3Error, S3RequestError
+from S3.Config import Config
+from S3.S3 import S3
+from S3.S3Uri import S3Uri
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_PUT(self):
+        body = self.rfile.read(int(self.headers.getheader("content-length", 0)))
+        server = self.server
+        server.hits.setdefault(self.path, 0)
+        server.hits[self.path] += 1
+        name = self.path.rsplit("/", 1)[-1]
+        if name.startswith("drop") and server.hits[self.path] == 1:
+            ## Hang up without answering
+            self.close_connection = 1
+            return
+        if name.startswith("busy") and server.hits[self.path] == 1:
+            self.reply(503, "<Error><Code>SlowDown</Code><Message>Busy</Message></Error>")
+            return
+        if name.startswith("denied"):
+            self.reply(403, "<Error><Code>AccessDenied</Code><Message>Denied</Message></Error>")
+            return
+        server.bodies[self.path] = body
+        self.reply(200, "", { "ETag": '"0"' })
+
+    def do_DELETE(self):
+        self.reply(204, "")
+
+    def reply(self, status, data, headers = {}):
+        self.send_response(status)
+        for header in headers.keys():
+            self.send_header(header, headers[header])
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    ## Threads, as the transport keeps several connections open at once
+    daemon_threads = True
+
+class AsyncTransportTest(unittest.TestCase):
+    def setUp(self):
+        self.server = Server(("127.0.0.1", 0), Handler)
+        self.server.hits = {}
+        self.server.bodies = {}
+        self.thread = threading.Thread(target = self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+        cfg = Config()
+        cfg.host_base = cfg.host_bucket = "127.0.0.1:%d" % self.server.server_address[1]
+        cfg.use_https = False
+        cfg.proxy_host = ""
+        cfg.access_key = "access"
+        cfg.secret_key = "secret"
+        cfg.async_requests = 4
+        self.s3 = S3(cfg)
+        self.s3._fail_wait = lambda retries: 0
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def put(self, names):
+        jobs = []
+        for name in names:
+            request = self.s3.create_request("OBJECT_PUT", uri = S3Uri("s3://tt/%s" % name))
+            jobs.append((name, request, "data of %s" % name))
+        results = {}
+        for key, response, error in self.s3.send_requests(jobs):
+            results[key] = (response, error)
+        return results
+
+    def test_success(self):
+        names = [ "file%d" % i for i in range(10) ]
+        results = self.put(names)
+        self.assertEqual(sorted(results.keys()), names)
+        for name in names:
+            response, error = results[name]
+            self.assertEqual(error, None)
+            self.assertEqual(response["status"], 200)
+            self.assertEqual(self.server.bodies["/tt/%s" % name], "data of %s" % name)
+
+    def test_delete(self):
+        jobs = [ (name, S3Uri("s3://tt/%s" % name)) for name in ("a", "b") ]
+        results = list(self.s3.object_delete_many(jobs))
+        self.assertEqual(sorted([ (key, response["status"], error) for key, response, error in results ]),
+                         [ ("a", 204, None), ("b", 204, None) ])
+
+    def test_client_error(self):
+        results = self.put([ "denied", "file" ])
+        response, error = results["denied"]
+        self.assertEqual(response["status"], 403)
+        self.assert_(isinstance(error, S3Error))
+        self.assertEqual(error.code, "AccessDenied")
+        self.assertEqual(self.server.hits["/tt/denied"], 1)
+        self.assertEqual(results["file"][1], None)
+
+    def test_server_error_retried(self):
+        results = self.put([ "busy", "file" ])
+        response, error = results["busy"]
+        self.assertEqual(error, None)
+        self.assertEqual(response["status"], 200)
+        self.assertEqual(self.server.hits["/tt/busy"], 2)
+        self.assertEqual(self.server.bodies["/tt/busy"], "data of busy")
+
+    def test_connection_dropped(self):
+        results = self.put([ "drop", "file" ])
+        response, error = results["drop"]
+        self.assertEqual(error, None)
+        self.assertEqual(response["status"], 200)
+        self.assertEqual(self.server.hits["/tt/drop"], 2)
+
+    def test_retries_exhausted(self):
+        self.s3._max_retries = 0
+        results = self.put([ "drop" ])
+        response, error = results["drop"]
+        self.assertEqual(response, None)
+        self.assert_(isinstance(error, S3RequestError))
+
+if __name__ == "__main__":
+    unittest.main()
+
+# vim:et:ts=4:sts=4:ai
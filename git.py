@@ -7,7 +7,9 @@ from fabric.api import env, local
 from fabric.context_managers import lcd
 from fabric.operations import prompt
 from fabric.utils import puts
+from .fos import join
 from .utils import abort, warn
+from . import versions
 
 
 _re_ready_status = r'(.*)\n(nothing to commit|Your branch is up-to-date)'
@@ -23,45 +25,54 @@ def check_clean(force=False):
         abort(_not_ready_msg)      
 
     
-def tags():
-    """Get list of current tags"""
+def _list_tags():
+    """Get names of all tags"""
     with lcd(env.project_path):
-        tags = local('cd %(project_path)s;git tag' % env, capture=True)
+        tags = local('git for-each-ref --format="%(refname:short)" refs/tags',
+            capture=True)
+    return [x.strip() for x in tags.split('\n') if x.strip()]
+
+
+def version_index():
+    """Get the index of version tags, rebuilt only when tags change"""
+    return versions.load_index(join(env.project_path, '.git'), _list_tags)
 
-    if tags:
-        stripped = [x.strip() for x in tags.strip().split('\n')]
-        re_num = re.compile('[^0-9.]')
-        sorted_tags = reversed(sorted([map(int, re_num.sub('', t).split('.')) for t in stripped]))
-        rebuilt = ['.'.join(map(str,t)) for t in sorted_tags]
-        return rebuilt
-    return []
+
+def tags():
+    """Get list of current version tags, newest first"""
+    return version_index().tags()
 
 
 def last_tag():
     """Get the last version tag"""
-    tag_list = tags()
-    if tag_list:
-        return '.'.join(map(str, tag_list[-1]))
+    latest = version_index().latest()
+    if latest:
+        return latest.tag
     return None  
 
 
 def prompt_tag(msg, unique=False):
-    """Prompt user for a version tag.  Pass unique=True to require a new one."""
-    tag_list = tags()
+    """
+    Prompt user for a version tag.  Pass unique=True to require a new one,
+    given without a "v" prefix (it's added where the version is used).
+    """
+    index = version_index()
     puts('This project has the following tags:')
-    puts(tag_list)
+    puts(index.tags())
         
     while True:
         version = prompt("%s: " % msg).strip()      
         if unique:
-            if not re.match(r'^[0-9]+\.[0-9]+\.[0-9]+$', version):
+            if version.startswith('v'):
+                version = version[1:]
+            if not versions.Version.parse(version):
                 warn('Invalid version number, must be in the format:' \
-                    ' major.minor.revision')
-            elif version in tag_list:
+                    ' major.minor.revision[-prerelease]')
+            elif index.find(version):
                 warn('Invalid version number, tag already exists')
             else:
                 break   
-        elif not version in tag_list:
+        elif not index.exists(version):
             warn('You must enter an existing version')
         else:
             break
@@ -69,17 +80,25 @@ def prompt_tag(msg, unique=False):
     return version   
 
 
-def push_tag(version):
-    """Create and push a tag"""
+def push_tag(version, push_branch=False):
+    """
+    Create and push a tag.  Pass push_branch=True to push the current
+    branch along with the tag, atomically and in a single round trip.
+    """
     with lcd(env.project_path):
         local('git tag %s' % version)
-        local('git push origin %s' % version)    
+        versions.invalidate(join(env.project_path, '.git'))
+        if push_branch:
+            local('git push --atomic origin HEAD refs/tags/%s' % version)
+        else:
+            local('git push origin refs/tags/%s' % version)
 
 
 def delete_tag(version):
     """Delete and push a tag"""
     with lcd(env.project_path):
         local('git tag -d %s' % version)
+        versions.invalidate(join(env.project_path, '.git'))
         local('git push origin :refs/tags/%s' % version)    
    
         
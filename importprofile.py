@@ -0,0 +1,103 @@
+"""
+Import-time profiler for fabfiles.
+
+Run as a script, not as part of the fablib package, so that the package
+itself is measured along with everything else:
+
+    python importprofile.py path/to/fabfile.py [limit]
+"""
+import __builtin__
+import os
+import sys
+import time
+
+_original_import = __builtin__.__import__
+
+# Time spent in nested imports, one entry per active import
+_stack = []
+
+# {module name: [cumulative seconds, self seconds]}
+_records = {}
+
+
+def _candidates(name, globals, fromlist, level):
+    """Module names an __import__ call might load"""
+    package = ''
+    if globals and level != 0:
+        package = globals.get('__package__')
+        if package is None:
+            package = globals.get('__name__', '')
+            if not '__path__' in globals:
+                package = package.rpartition('.')[0]
+        for i in range(max(level, 1) - 1):
+            package = package.rpartition('.')[0]
+
+    names = []
+    if name:
+        if package:
+            names.append(package + '.' + name)
+        if level <= 0:
+            names.append(name)
+    elif package:
+        names.append(package)
+    for base in list(names):
+        for item in fromlist or ():
+            if item != '*':
+                names.append(base + '.' + item)
+    return names
+
+
+def _timed_import(name, globals=None, locals=None, fromlist=None, level=-1):
+    """Wrap __import__, recording time spent loading new modules"""
+    missing = [m for m in _candidates(name, globals, fromlist, level)
+        if not m in sys.modules]
+    _stack.append(0.0)
+    start = time.time()
+    try:
+        return _original_import(name, globals, locals, fromlist, level)
+    finally:
+        elapsed = time.time() - start
+        nested = _stack.pop()
+        if _stack:
+            _stack[-1] += elapsed
+
+        loaded = [m for m in missing if sys.modules.get(m) is not None]
+        if loaded:
+            _records[', '.join(loaded)] = [elapsed, elapsed - nested]
+
+
+def profile(fabfile_path):
+    """Import fabfile_path with timing enabled, return total seconds"""
+    project_path = os.path.dirname(os.path.abspath(fabfile_path))
+    if not project_path in sys.path:
+        sys.path.insert(0, project_path)
+    module_name = os.path.splitext(os.path.basename(fabfile_path))[0]
+
+    __builtin__.__import__ = _timed_import
+    start = time.time()
+    try:
+        __import__('fabric.api')
+        __import__(module_name)
+    finally:
+        __builtin__.__import__ = _original_import
+    return time.time() - start
+
+
+def report(total, limit=25, stream=sys.stdout):
+    """Write the slowest imports to stream"""
+    stream.write('\n%10s %10s  %s\n' % ('cumul(ms)', 'self(ms)', 'module'))
+    ranked = sorted(_records.items(), key=lambda x: x[1][0], reverse=True)
+    for name, (cumulative, own) in ranked[:limit]:
+        stream.write('%10.1f %10.1f  %s\n' % (cumulative * 1000, own * 1000, name))
+    stream.write('\nTotal: %.1f ms for %d modules\n' % (total * 1000, len(_records)))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        sys.stderr.write(__doc__)
+        sys.exit(1)
+    # Don't let fablib's own modules shadow top-level ones (e.g. git)
+    if os.path.abspath(sys.path[0]) == os.path.dirname(os.path.abspath(__file__)):
+        del sys.path[0]
+    limit = int(sys.argv[2]) if len(sys.argv) > 2 else 25
+    report(profile(sys.argv[1]), limit)
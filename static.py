@@ -23,12 +23,52 @@ BANNER = """
 """.strip()
 
 
-def load_config(config_file):
-    """Read config.json, add date, year, paths"""
+# Operations allowed in the "build" section of config.json
+BUILD_OPERATIONS = ('banner', 'concat', 'copy', 'lessc', 'minify', 'process',
+    'usemin', 'npm_run')
+
+
+def _check_config(config, config_file):
+    """Check the structure of a freshly parsed config file"""
+    def _fail(msg):
+        abort('Invalid config file %s: %s' % (config_file, msg))
+
+    if not isinstance(config, dict):
+        _fail('expected an object at the top level')
+    if 'build' in config:
+        if not isinstance(config['build'], dict):
+            _fail('"build" must be an object')
+        for key in config['build']:
+            if not key in BUILD_OPERATIONS:
+                _fail('unknown build operation "%s"' % key)
+    if 'stage' in config:
+        if not isinstance(config['stage'], list):
+            _fail('"stage" must be a list')
+        for r in config['stage']:
+            if not isinstance(r, dict) or not 'src' in r:
+                _fail('each "stage" entry must be an object with a "src"')
+    if 'deploy' in config:
+        if not isinstance(config['deploy'], dict):
+            _fail('"deploy" must be an object')
+        for env_type, r in config['deploy'].iteritems():
+            if not isinstance(r, dict):
+                _fail('"deploy.%s" must be an object' % env_type)
+
+
+def _parse_config(config_file):
+    """Parse and check config.json, stripping // comments"""
     with open(config_file) as fp:
         s = fp.read()
         s = re.sub(r'^\s*//.*[\r\n]*', '', s, flags=re.MULTILINE)
         config = json.loads(s, object_pairs_hook=collections.OrderedDict)
+    _check_config(config, config_file)
+    return config
+
+
+def load_config(config_file):
+    """Read config.json, check its structure, add date, year, paths"""
+    config_file = os.path.abspath(config_file)
+    config = _parse_config(config_file)
 
     today = date.today()
     config['date'] = today
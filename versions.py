@@ -0,0 +1,175 @@
+"""
+Semantic version tags
+"""
+import bisect
+import os
+import re
+
+# major.minor.patch with optional v prefix, prerelease and build metadata
+_re_version = re.compile(r'^v?(0|[1-9][0-9]*)\.(0|[1-9][0-9]*)\.(0|[1-9][0-9]*)'
+    r'(?:-([0-9A-Za-z-]+(?:\.[0-9A-Za-z-]+)*))?'
+    r'(?:\+([0-9A-Za-z-]+(?:\.[0-9A-Za-z-]+)*))?$')
+
+# Older tags, e.g. 1.2 or 01.02.03, read as major.minor.patch
+_re_loose_version = re.compile(r'^v?([0-9]+)\.([0-9]+)(?:\.([0-9]+))?$')
+
+# Loaded indexes, by git directory: {git_dir: (stamp, VersionIndex)}
+_index_cache = {}
+
+
+class Version(object):
+    """A parsed version tag, ordered by semver precedence"""
+    __slots__ = ('tag', 'major', 'minor', 'patch', 'prerelease', 'build', 'key')
+
+    def __init__(self, tag, major, minor, patch, prerelease=None, build=None):
+        self.tag = tag
+        self.major = major
+        self.minor = minor
+        self.patch = patch
+        self.prerelease = prerelease
+        self.build = build
+
+        # Releases sort after their prereleases; numeric prerelease
+        # identifiers sort before alphanumeric ones
+        if prerelease:
+            ids = tuple((0, int(x), '') if x.isdigit() else (1, 0, x)
+                for x in prerelease.split('.'))
+            self.key = (major, minor, patch, 0, ids)
+        else:
+            self.key = (major, minor, patch, 1, ())
+
+    @classmethod
+    def parse(cls, tag, loose=False):
+        """
+        Parse tag, returning None if it isn't a version.  Pass loose=True
+        to also accept two-part versions and leading zeros.
+        """
+        m = _re_version.match(tag)
+        if m:
+            major, minor, patch, prerelease, build = m.groups()
+            return cls(tag, int(major), int(minor), int(patch), prerelease, build)
+        if loose:
+            m = _re_loose_version.match(tag)
+            if m:
+                major, minor, patch = m.groups()
+                return cls(tag, int(major), int(minor), int(patch or 0))
+        return None
+
+    @property
+    def series(self):
+        """(major, minor)"""
+        return (self.major, self.minor)
+
+    def __cmp__(self, other):
+        return cmp(self.key, other.key)
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __str__(self):
+        return self.tag
+
+    def __repr__(self):
+        return 'Version(%r)' % self.tag
+
+
+class VersionIndex(object):
+    """Version tags sorted oldest to newest"""
+
+    def __init__(self, versions):
+        """versions must already be sorted, see from_tags()"""
+        self.versions = versions
+        self._keys = [v.key for v in self.versions]
+        self._tags = set(v.tag for v in self.versions)
+
+    @classmethod
+    def from_tags(cls, tag_list):
+        """Build an index from tag names, ignoring non-version tags"""
+        return cls(sorted(v for v in
+            [Version.parse(tag, loose=True) for tag in tag_list] if v))
+
+    def __len__(self):
+        return len(self.versions)
+
+    def tags(self):
+        """Tag names, newest first"""
+        return [v.tag for v in reversed(self.versions)]
+
+    def exists(self, tag):
+        """Is tag one of the indexed version tags?"""
+        return tag in self._tags
+
+    def find(self, tag):
+        """Indexed version with the same precedence as tag, or None"""
+        v = Version.parse(tag, loose=True)
+        if v:
+            i = bisect.bisect_left(self._keys, v.key)
+            if i < len(self._keys) and self._keys[i] == v.key:
+                return self.versions[i]
+        return None
+
+    def latest(self, prerelease=False):
+        """Newest version, skipping prereleases unless prerelease=True"""
+        for v in reversed(self.versions):
+            if prerelease or not v.prerelease:
+                return v
+        return None
+
+    def latest_in_series(self, series, prerelease=False):
+        """
+        Newest version in a series given as 'major' or 'major.minor'
+        (e.g. '1' or '1.2'), skipping prereleases unless prerelease=True
+        """
+        parts = [int(x) for x in str(series).lstrip('v').split('.')]
+        if not 1 <= len(parts) <= 2:
+            raise ValueError('Invalid version series: %s' % series)
+        upper = tuple(parts[:-1]) + (parts[-1] + 1,)
+        i = bisect.bisect_left(self._keys, upper + (0,) * (3 - len(upper)))
+        while i > 0:
+            i -= 1
+            v = self.versions[i]
+            if (v.major, v.minor)[:len(parts)] != tuple(parts):
+                break
+            if prerelease or not v.prerelease:
+                return v
+        return None
+
+
+def _refs_stamp(git_dir):
+    """Modification stamp for the tag refs in git_dir, or None"""
+    packed_refs = os.path.join(git_dir, 'packed-refs')
+    tags_dir = os.path.join(git_dir, 'refs', 'tags')
+    if not os.path.isdir(tags_dir):
+        return None
+    stamp = []
+    if os.path.exists(packed_refs):
+        st = os.stat(packed_refs)
+        stamp.append((st.st_mtime, st.st_size))
+    for dir_path, dir_names, file_names in os.walk(tags_dir):
+        stamp.append((dir_path, os.stat(dir_path).st_mtime))
+    return tuple(stamp)
+
+
+def invalidate(git_dir):
+    """Forget any cached index for git_dir"""
+    _index_cache.pop(os.path.abspath(git_dir), None)
+
+
+def load_index(git_dir, list_tags):
+    """
+    Get the VersionIndex for the repository at git_dir.  list_tags() is
+    only called to get the tag names when the refs have changed since the
+    index was last built.
+    """
+    git_dir = os.path.abspath(git_dir)
+    stamp = _refs_stamp(git_dir)
+    if stamp is None:
+        return VersionIndex.from_tags(list_tags())
+
+    cached = _index_cache.get(git_dir)
+    if cached and cached[0] == stamp:
+        return cached[1]
+
+    index = VersionIndex.from_tags(list_tags())
+    _index_cache[git_dir] = (stamp, index)
+    return index